@@ -0,0 +1,291 @@
+"""
+Offline benchmark of the polling and notification path.
+
+Serves synthetic game files from a fake Unciv server running in a separate process, subscribes the requested number
+of registrations through `create_notify_job` and lets the poll jobs run against a stub bot for a while. Reports the
+poll throughput, job lag, notifications, decode times, CPU time and memory of the bot process.
+
+    python benchmark.py --registrations 5000 --games 1000 --size 2000000 --duration 120
+
+With --compare-json only the decoding of a single save is timed with every installed JSON backend. With
+--profile-imports the bot is imported in a fresh interpreter and the slowest imports are reported, to keep an eye on
+the start-up time.
+
+The bot configuration is read from the environment as usual, e.g. DECODE_WORKERS=4 python benchmark.py. With
+POLL_WORKERS set, the decode times, CPU time and memory cover the bot process only, not the poll workers.
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import functools
+import gzip
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Any
+
+os.environ.setdefault("CHAT_TOKEN", "123456:benchmark")
+
+from aiohttp import web
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
+from telegram import User
+from telegram.ext import ApplicationBuilder, ExtBot
+
+from data import create_notify_job, stop_watching, report_game_state
+from datatypes import Registration, get_config
+from delivery import start_delivery, stop_delivery
+from reader import open_session, close_session, shutdown_decoder, get_decode_stats, available_json_backends, _decode
+from workers import start_workers, stop_workers
+
+_SERVER = "http://127.0.0.1"
+
+
+class _StubBot(ExtBot):
+    """ Bot recording sent messages instead of calling Telegram """
+
+    sent: int
+    send_seconds: float
+
+    def __init__(self, token: str, send_seconds: float):
+        super().__init__(token)
+        with self._unfrozen():
+            self.sent = 0
+            self.send_seconds = send_seconds
+
+    async def get_me(self, *args: Any, **kwargs: Any) -> User:
+        with self._unfrozen():
+            self._bot_user = User(id=123456, first_name="Benchmark", is_bot=True, username="benchmark_bot")
+        return self._bot_user
+
+    async def send_message(self, chat_id: int, text: str, *args: Any, **kwargs: Any) -> None:
+        await asyncio.sleep(self.send_seconds)
+        with self._unfrozen():
+            self.sent += 1
+
+
+def _build_save(size: int, players: int, player: int, turn: int) -> bytes:
+    """ Base64-encoded gzipped save padded to about `size` bytes of JSON, the polled keys come after the padding """
+
+    civilizations = [{"civName": f"Nation{i}", "playerId": f"player-{i}", "playerType": "Human"} for i in range(players)]
+    save = {
+        "civilizations": civilizations,
+        "tileMap": {"tiles": ["x" * 100] * max(0, size // 104)},
+        "gameParameters": {"players": [{"playerId": f"player-{i}", "playerType": "Human"} for i in range(players)]},
+        "currentPlayer": f"Nation{player}",
+        "turns": turn,
+    }
+    return base64.b64encode(gzip.compress(json.dumps(save).encode("utf8")))
+
+
+def _run_server(port: multiprocessing.Value, requests: multiprocessing.Value, args: argparse.Namespace) -> None:
+    """ Fake Unciv server, the current player of every game moves on every `turn_seconds` """
+
+    started = time.monotonic()
+    saves: dict[tuple[int, int], bytes] = dict()
+
+    async def handle(request: web.Request) -> web.Response:
+        game = int(request.match_info["gameid"].rsplit("-", 1)[1])
+        # Games are offset against each other, so they do not all change at the same moment
+        step = int((time.monotonic() - started) / args.turn_seconds + game / args.games)
+        state = (step // args.players, step % args.players)
+        if state not in saves:
+            saves[state] = _build_save(args.size, args.players, state[1], state[0])
+        with requests.get_lock():
+            requests.value += 1
+        return web.Response(body=saves[state])
+
+    async def serve() -> None:
+        app = web.Application()
+        app.router.add_get("/files/{gameid}", handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port.value = runner.addresses[0][1]
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+def _get_rss() -> int:
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize()
+
+
+async def _benchmark(args: argparse.Namespace) -> None:
+    port = multiprocessing.Value("i", 0)
+    requests = multiprocessing.Value("l", 0)
+    server = multiprocessing.Process(target=_run_server, args=(port, requests, args), daemon=True)
+    server.start()
+    while not port.value:
+        await asyncio.sleep(0.05)
+
+    bot = _StubBot(os.environ["CHAT_TOKEN"], args.send_seconds)
+    application = ApplicationBuilder().bot(bot).updater(None).build()
+    await application.initialize()
+    await open_session()
+    start_delivery(bot)
+    if get_config().POLL_WORKERS > 0:
+        start_workers(get_config().POLL_WORKERS, functools.partial(report_game_state, application))
+
+    lags = list()
+
+    def observe(event: JobSubmissionEvent) -> None:
+        for scheduled in event.scheduled_run_times:
+            lags.append((datetime.now(scheduled.tzinfo) - scheduled).total_seconds())
+
+    application.job_queue.scheduler.add_listener(observe, EVENT_JOB_SUBMITTED)
+    await application.start()
+
+    cpu_started = time.process_time()
+    started = time.perf_counter()
+    for i in range(args.registrations):
+        registration = Registration(
+            name=f"game-{i}",
+            server=f"{_SERVER}:{port.value}",
+            gameid=f"00000000-0000-0000-0000-{i % args.games:012d}",
+            nation=f"Nation{i % args.players}",
+            chatid=i,
+            period=args.period
+        )
+        application.user_data[i]["games"] = [registration]
+        await create_notify_job(application.job_queue, registration)
+    registration_seconds = time.perf_counter() - started
+
+    await asyncio.sleep(args.duration)
+    duration = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    polls = requests.value
+
+    await application.stop()
+    stop_watching()
+    await stop_workers()
+    await stop_delivery()
+    await close_session()
+    shutdown_decoder()
+    await application.shutdown()
+    server.terminate()
+
+    decode = get_decode_stats()
+    lags.sort()
+    report = {
+        "registrations": args.registrations,
+        "games": args.games,
+        "save size [B]": args.size,
+        "registration time [s]": registration_seconds,
+        "polls": polls,
+        "polls per second": polls / duration,
+        "job lag p50 [s]": statistics.median(lags) if lags else 0,
+        "job lag p95 [s]": lags[int(len(lags) * 0.95)] if lags else 0,
+        "job lag max [s]": lags[-1] if lags else 0,
+        "notifications sent": bot.sent,
+        "decodes": decode["count"],
+        "decode mean [s]": decode["total"] / decode["count"] if decode["count"] else 0,
+        "decode max [s]": decode["max"],
+        "CPU time [s]": cpu,
+        "CPU utilization": cpu / duration,
+        "RSS [MB]": _get_rss() / 2 ** 20,
+        "peak RSS [MB]": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10,
+    }
+    width = max(len(name) for name in report)
+    for name, value in report.items():
+        print(f"{name:<{width}}  {value:.3f}" if isinstance(value, float) else f"{name:<{width}}  {value}")
+
+
+def _compare_json(args: argparse.Namespace) -> None:
+    payload = _build_save(args.size, args.players, 0, 1)
+    keys = frozenset({"currentPlayer", "turns"})
+    rounds = 10
+
+    print(f"{'backend':<10}  {'full [s]':>10}  {'keys [s]':>10}  {'stream [s]':>10}")
+    for backend in available_json_backends():
+        started = time.perf_counter()
+        for _ in range(rounds):
+            _decode(payload, backend=backend)
+        full = (time.perf_counter() - started) / rounds
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            _decode(payload, keys, backend=backend, streaming=False)
+        partial = (time.perf_counter() - started) / rounds
+
+        started = time.perf_counter()
+        for _ in range(rounds):
+            _decode(payload, keys, backend=backend, streaming=True)
+        streamed = (time.perf_counter() - started) / rounds
+
+        print(f"{backend:<10}  {full:>10.4f}  {partial:>10.4f}  {streamed:>10.4f}")
+
+
+def _profile_imports(args: argparse.Namespace) -> None:
+    """ Import main.py with -X importtime and report its direct imports and the modules slowest to import """
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    wall = time.perf_counter() - started
+
+    imports = list()
+    for line in result.stderr.splitlines():
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        # Every level of nesting indents the module name by two more spaces
+        depth = (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2
+        imports.append((fields[2].strip(), depth, int(fields[0]) / 1e6, int(fields[1]) / 1e6))
+
+    # Modules are listed after everything they import, the modules imported for main come right before it
+    end = next(i for i, (name, depth, _, _) in enumerate(imports) if name == "main" and depth == 0)
+    start = max((i + 1 for i in range(end) if imports[i][1] == 0), default=0)
+    total = imports[end][3]
+    imports = imports[start:end]
+
+    print(f"interpreter with imports [s]  {wall:.3f}")
+    print(f"import main [s]               {total:.3f}")
+
+    print(f"\n{'imported by main':<40}  {'cumulative [s]':>14}")
+    direct = [entry for entry in imports if entry[1] == 1]
+    for name, _, _, cumulative in sorted(direct, key=lambda entry: entry[3], reverse=True)[:args.top]:
+        print(f"{name:<40}  {cumulative:>14.4f}")
+
+    print(f"\n{'module':<40}  {'self [s]':>14}")
+    for name, _, own, _ in sorted(imports, key=lambda entry: entry[2], reverse=True)[:args.top]:
+        print(f"{name:<40}  {own:>14.4f}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--registrations", type=int, default=2000, help="number of registrations")
+    parser.add_argument("--games", type=int, default=500, help="number of distinct games")
+    parser.add_argument("--players", type=int, default=4, help="number of players in every game")
+    parser.add_argument("--size", type=int, default=200_000, help="approximate size of the save JSON in bytes")
+    parser.add_argument("--period", type=float, default=10, help="polling period of registrations in seconds")
+    parser.add_argument("--turn-seconds", type=float, default=30, help="seconds until the next player is on turn")
+    parser.add_argument("--send-seconds", type=float, default=0.05, help="simulated latency of sending a message")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run the poll jobs for")
+    parser.add_argument("--compare-json", action="store_true", help="only compare decoding with the JSON backends")
+    parser.add_argument("--profile-imports", action="store_true", help="only report the import time of the bot")
+    parser.add_argument("--top", type=int, default=15, help="number of modules reported by --profile-imports")
+    args = parser.parse_args()
+
+    if args.compare_json:
+        _compare_json(args)
+    elif args.profile_imports:
+        _profile_imports(args)
+    else:
+        asyncio.run(_benchmark(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+import os
+
+# The configuration is read from the environment, the bot token is the only required variable
+os.environ.setdefault("CHAT_TOKEN", "123456:test")
@@ -1,99 +1,433 @@
-from datetime import timedelta, datetime
+from __future__ import annotations
+
+import asyncio
+import math
+import random
+import time
+from datetime import timedelta
 from logging import getLogger
-from typing import Any, Callable
+from typing import Any
+from urllib.parse import urlsplit
 
-from telegram.constants import ParseMode
-from telegram.ext import JobQueue, Job, ContextTypes, CallbackContext
+from telegram.ext import JobQueue, Job, ContextTypes, CallbackContext, Application
 
-from reader import gamefile
+from datatypes import get_config, Registration
+from delivery import deliver
+from metrics import Counter, Gauge, Histogram
+from reader import gamefile, forget, game_exists, get_game_source, GamefileError, ServerUnavailableError
+from workers import workers_running, assign_game, release_game
 
 _logger = getLogger(__name__)
 
+# Registrations with a running notification job, the same objects are stored in user_data["games"]
+# (chatid, name) -> registration
+_registrations: dict[tuple[int, str], Registration] = dict()
+# chatid -> {name: registration}, the registrations of _registrations by chat
+_chat_registrations: dict[int, dict[str, Registration]] = dict()
+# (server, gameid) -> {(chatid, name): registration}
+_subscriptions: dict[tuple[str, str], dict[tuple[int, str], Registration]] = dict()
+# (server, gameid) -> poll job
+_poll_jobs: dict[tuple[str, str], Job] = dict()
+# (server, gameid) -> task waiting for changes of the game, see reader.GameSource
+_watchers: dict[tuple[str, str], asyncio.Task] = dict()
+# Games whose cached file is kept up to date by their watcher
+_watched: set[tuple[str, str]] = set()
+# (server, gameid) -> state of the game at the last poll, see _notify_subscribers
+_snapshots: dict[tuple[str, str], _GameSnapshot] = dict()
 
-def has_games(user_data: dict[str, Any] | None) -> bool:
-    return user_data and "games" in user_data and user_data["games"]
+_POLL_SECONDS = Histogram("unciv_poll_seconds", "Duration of game file polls", ("server",))
+_POLL_FAILURES = Counter("unciv_poll_failures_total", "Game file polls that failed", ("server",))
+_NOTIFICATIONS = Counter("unciv_notifications_total", "Turn notifications enqueued for sending", ("server",))
+Gauge("unciv_registrations", "Registered turn notifications", lambda: len(_registrations))
+Gauge("unciv_polled_games", "Games with a poll job", lambda: len(_poll_jobs))
 
 
-def get_game(user_data: dict[str, Any] | None, fltr: Callable[[dict[str, Any]], bool]):
-    if not has_games(user_data):
-        return None
+def has_games(user_data: dict[str, Any] | None) -> bool:
+    return user_data and "games" in user_data and user_data["games"]
 
-    for game in user_data["games"]:
-        if fltr(game):
-            return game
 
-    return None
+def get_registration(chat_id: int, name: str) -> Registration | None:
+    return _registrations.get((chat_id, name), None)
 
 
-def list_games(user_data: dict[str, Any] | None):
+def list_games(user_data: dict[str, Any] | None) -> list[Registration]:
     if not has_games(user_data):
         return []
 
     return user_data["games"]
 
-async def create_notify_job(job_queue: JobQueue, registration_data: dict[str, Any]) -> Job:
-    period = registration_data["period"]
-    gameid = registration_data["gameid"]
-    chatid = registration_data["chatid"]
-    name = registration_data["name"]
-
-    return job_queue.run_repeating(
-        _run_notification_task,
-        interval=period, first=period,
-        data=name, chat_id=chatid,
-        name=f"notify-{chatid}-{name}"
+
+def list_chat_registrations(chat_id: int) -> list[Registration]:
+    """ Return the registrations notifying the chat, including those of other members of a group chat """
+
+    return list(_chat_registrations.get(chat_id, dict()).values())
+
+
+def remove_registration(application: Application, registration: Registration) -> None:
+    """ Unsubscribe the registration and remove it from the user data of the user who registered it """
+
+    remove_notify_job(application.job_queue, registration)
+    user_data = application.user_data.get(registration.owner_id, None)
+    if has_games(user_data) and registration in user_data["games"]:
+        user_data["games"].remove(registration)
+        application.mark_data_for_update_persistence(user_ids=registration.owner_id)
+
+
+def restore_registrations(application: Application) -> int:
+    """
+    Index the registrations loaded from the persistence store without scheduling their poll jobs, which is left to
+    `restore_notify_jobs`. Return the number of registrations.
+    """
+
+    count = 0
+    for user_id, user_data in application.user_data.items():
+        if not has_games(user_data):
+            _logger.debug("user_id %s has no games, skipping", user_id)
+            continue
+
+        for registration in user_data["games"]:
+            registration.userid = user_id
+            _subscribe(registration)
+            count += 1
+
+    return count
+
+
+async def restore_notify_jobs(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Schedule the poll jobs of the restored registrations in batches, yielding to the event loop between the batches
+    so the bot keeps serving commands meanwhile
+    """
+
+    config = get_config()
+    started = time.perf_counter()
+
+    if config.STARTUP_PRUNE_MISSING_GAMES:
+        await _prune_missing_games(context)
+
+    game_keys = list(_subscriptions)
+    for start in range(0, len(game_keys), config.STARTUP_BATCH_SIZE):
+        for game_key in game_keys[start:start + config.STARTUP_BATCH_SIZE]:
+            if _subscriptions.get(game_key, None):
+                _schedule_poll_job(context.job_queue, *game_key)
+        await asyncio.sleep(0)
+
+    _logger.info("Scheduled poll jobs of %s games in %.3f s", len(game_keys), time.perf_counter() - started)
+
+
+async def create_notify_job(job_queue: JobQueue, registration: Registration) -> str:
+    """ Subscribe the registration to the poll job of its game, creating the job if needed. Return the job name. """
+
+    _subscribe(registration)
+    return _schedule_poll_job(job_queue, *registration.game_key)
+
+
+def remove_notify_job(job_queue: JobQueue, registration: Registration) -> None:
+    """ Unsubscribe the registration, removing the poll job of its game once nobody is subscribed """
+
+    game_key = registration.game_key
+    _registrations.pop(registration.key, None)
+    chat_registrations = _chat_registrations.get(registration.chatid, dict())
+    chat_registrations.pop(registration.name, None)
+    if not chat_registrations:
+        _chat_registrations.pop(registration.chatid, None)
+    subscribers = _subscriptions.get(game_key, dict())
+    subscribers.pop(registration.key, None)
+    _snapshots.pop(game_key, None)
+
+    if subscribers:
+        _schedule_poll_job(job_queue, *game_key)
+        return
+
+    _subscriptions.pop(game_key, None)
+    _stop_watching(game_key)
+    release_game(*game_key)
+    forget(*game_key)
+    job = _poll_jobs.pop(game_key, None)
+    if job is not None:
+        job.enabled = False
+        job.schedule_removal()
+
+
+def _subscribe(registration: Registration) -> None:
+    _registrations[registration.key] = registration
+    _chat_registrations.setdefault(registration.chatid, dict())[registration.name] = registration
+    _subscriptions.setdefault(registration.game_key, dict())[registration.key] = registration
+    # The new subscriber may need to be notified of the current state
+    _snapshots.pop(registration.game_key, None)
+
+
+async def _prune_missing_games(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """ Check all restored games in parallel and drop the registrations of games the server does not know anymore """
+
+    async def check(game_key: tuple[str, str]) -> bool:
+        try:
+            return await game_exists(*game_key)
+        except ServerUnavailableError as err:
+            _logger.warning("Could not check game server=%s, gameid=%s, keeping it: %s", *game_key, err)
+            return True
+        except Exception:
+            _logger.warning("Could not check game server=%s, gameid=%s, keeping it", *game_key, exc_info=True)
+            return True
+
+    game_keys = list(_subscriptions)
+    exists = await asyncio.gather(*(check(game_key) for game_key in game_keys))
+
+    for game_key, found in zip(game_keys, exists):
+        if found:
+            continue
+
+        for registration in list(_subscriptions.get(game_key, dict()).values()):
+            _logger.warning("Removing registration of a missing game %s", registration)
+            remove_registration(context.application, registration)
+
+
+def _schedule_poll_job(job_queue: JobQueue, server: str, gameid: str) -> str:
+    """ Make sure the game is polled with the shortest period requested by its subscribers """
+
+    period = min(registration.period for registration in _subscriptions[(server, gameid)].values())
+
+    if workers_running():
+        assign_game(server, gameid, period)
+        return _get_poll_job_name(server, gameid)
+
+    job = _poll_jobs.get((server, gameid), None)
+    if job is not None and not job.removed:
+        if job.data["period"] == period:
+            # The subscribers changed, so poll at their period again instead of the interval backed off for the others
+            job.data.pop("state", None)
+            if job.data.pop("interval", period) != period:
+                job.job.reschedule(trigger="interval", seconds=period, jitter=period * get_config().POLL_JITTER)
+            return job.name
+        job.schedule_removal()
+
+    # Spread the first runs over the whole period and let every run drift a little, so jobs registered at the same
+    # time (e.g. restored after a restart) do not hit the server in lockstep
+    job = job_queue.run_repeating(
+        _run_poll_task,
+        interval=period, first=random.uniform(0, period),
+        data={"server": server, "gameid": gameid, "period": period},
+        name=_get_poll_job_name(server, gameid),
+        job_kwargs={"jitter": period * get_config().POLL_JITTER}
     )
+    _poll_jobs[(server, gameid)] = job
+
+    if get_config().GAME_SOURCE != "poll" and (server, gameid) not in _watchers:
+        _watchers[(server, gameid)] = asyncio.create_task(
+            _watch_game(job_queue, server, gameid), name=f"watch-{server}-{gameid}"
+        )
+
+    return job.name
+
+
+async def _watch_game(job_queue: JobQueue, server: str, gameid: str) -> None:
+    """
+    Run the poll job right away whenever the game source reports a change. While the source works, the poll job
+    reads the game from the cache the source keeps up to date instead of downloading it.
+    """
 
+    game_key = (server, gameid)
+    source = get_game_source()
+    config = get_config()
 
-async def _run_notification_task(context: ContextTypes.DEFAULT_TYPE):
-    name = context.job.data
-    user_data = context.application.user_data.get(context.job.chat_id, None)
+    while game_key in _subscriptions:
+        try:
+            changed = await source.wait_for_change(server, gameid, config.LONG_POLL_TIMEOUT)
+        except asyncio.CancelledError:
+            raise
+        except Exception as err:
+            log = _logger.debug if isinstance(err, ServerUnavailableError) else _logger.warning
+            log("Watching game failed server=%s, gameid=%s", server, gameid, exc_info=True)
+            _watched.discard(game_key)
+            await asyncio.sleep(config.LONG_POLL_TIMEOUT)
+            continue
 
-    job_data = get_game(user_data, lambda g: g["name"] == name)
+        if changed is None:
+            _logger.debug("Game cannot be watched, polling it server=%s, gameid=%s", server, gameid)
+            break
 
-    if not job_data:
+        _watched.add(game_key)
+        job = _poll_jobs.get(game_key, None)
+        if changed and job is not None:
+            await job.run(job_queue.application)
+
+    _watched.discard(game_key)
+    _watchers.pop(game_key, None)
+
+
+def stop_watching() -> None:
+    """ Stop waiting for changes of all games """
+
+    for game_key in list(_watchers):
+        _stop_watching(game_key)
+
+
+def _stop_watching(game_key: tuple[str, str]) -> None:
+    _watched.discard(game_key)
+    watcher = _watchers.pop(game_key, None)
+    if watcher is not None:
+        watcher.cancel()
+
+
+def _get_poll_job_name(server: str, gameid: str) -> str:
+    return f"poll-{server}-{gameid}"
+
+
+async def _run_poll_task(context: ContextTypes.DEFAULT_TYPE):
+    server = context.job.data["server"]
+    gameid = context.job.data["gameid"]
+    subscribers = _subscriptions.get((server, gameid), None)
+
+    if not subscribers:
+        if _poll_jobs.get((server, gameid), None) is context.job:
+            del _poll_jobs[(server, gameid)]
+            _stop_watching((server, gameid))
         _remove_job(context)
         return
-    
-    async with gamefile(job_data["server"], job_data["gameid"]) as f:
-        current_player_nation = f.get_value("currentPlayer")
-        current_player_turn = f.get_value("turns", required=False) or 0
-        
-    last_notification_turn = job_data.get("last_notification_turn", -1)
 
-    if current_player_nation != job_data["nation"]:
-        _logger.debug("Not players turn, skipping. checked=%s, turn=%s", current_player_nation, job_data["nation"])
-        return
+    host = urlsplit(server).netloc
+    with _POLL_SECONDS.time(host):
+        try:
+            max_age = math.inf if (server, gameid) in _watched else 0
+            async with gamefile(server, gameid, keys=("currentPlayer", "turns"), max_age=max_age) as f:
+                current_player_nation = f.get_value("currentPlayer")
+                current_player_turn = f.get_value("turns", required=False) or 0
+        except ServerUnavailableError as err:
+            # Outages are logged by the reader once per server, not by every poll job
+            _logger.debug("Polling game failed server=%s, gameid=%s: %s", server, gameid, err)
+            _POLL_FAILURES.inc(host)
+            return
+        except GamefileError as err:
+            _logger.warning("Polling game failed server=%s, gameid=%s: %s", server, gameid, err)
+            _POLL_FAILURES.inc(host)
+            return
+        except Exception:
+            _POLL_FAILURES.inc(host)
+            raise
+
+    reminder_due = _notify_subscribers(context.application, server, gameid, current_player_nation, current_player_turn)
+
+    if get_config().ADAPTIVE_POLLING:
+        _adapt_poll_interval(context.job, (current_player_nation, current_player_turn), reminder_due)
+
+
+async def report_game_state(application: Application, server: str, gameid: str, nation: str, turn: int) -> None:
+    """ Notify the subscribers of a game polled by a worker process, see workers.start_workers """
+
+    _notify_subscribers(application, server, gameid, nation, turn)
+
+
+def _notify_subscribers(
+        application: Application,
+        server: str,
+        gameid: str,
+        current_player_nation: str,
+        current_player_turn: int
+) -> float | None:
+    """
+    Notify the subscribers on turn and return the seconds until the earliest of their next reminders. While the game
+    state matches its snapshot and no reminder is due, the subscribers are not visited at all.
+    """
+
+    game_key = (server, gameid)
+    now = time.time()
+
+    snapshot = _snapshots.get(game_key, None)
+    if snapshot is not None and snapshot.matches(current_player_nation, current_player_turn, now):
+        return snapshot.reminder_due(now)
+
+    next_notification_at = math.inf
+    complete = True
+    for registration in list(_subscriptions.get(game_key, dict()).values()):
+        try:
+            changed = _run_notification_task(registration, current_player_nation, current_player_turn, now)
+        except Exception:
+            _logger.exception("Notification failed %s", registration)
+            complete = False
+            continue
+
+        if changed:
+            # The job is not bound to the chat, so the application does not know its user data was changed
+            application.mark_data_for_update_persistence(user_ids=registration.owner_id)
+
+        if registration.nation == current_player_nation:
+            next_notification_at = min(next_notification_at, registration.next_notification_at)
+
+    snapshot = _GameSnapshot(current_player_nation, current_player_turn, next_notification_at)
+    if complete:
+        _snapshots[game_key] = snapshot
+    else:
+        # Visit the subscribers again on the next poll
+        _snapshots.pop(game_key, None)
+    return snapshot.reminder_due(now)
+
+
+def _adapt_poll_interval(job: Job, state: tuple[str, int], reminder_due: float | None) -> None:
+    """
+    Poll at the subscribers' period right after the game state changed and back off exponentially up to
+    POLL_MAX_PERIOD while it stays the same, never sleeping past the next due reminder
+    """
+
+    config = get_config()
+    period = job.data["period"]
+    current_interval = job.data.get("interval", period)
+
+    if job.data.get("state", None) != state:
+        interval = period
+    else:
+        interval = min(current_interval * 2, max(period, config.POLL_MAX_PERIOD))
+        if reminder_due is not None:
+            interval = min(interval, max(period, reminder_due))
+
+    job.data["state"] = state
+    if interval != current_interval:
+        _logger.debug("Polling %s every %s seconds", job.name, interval)
+        job.data["interval"] = interval
+        job.job.reschedule(trigger="interval", seconds=interval, jitter=interval * config.POLL_JITTER)
+
+
+def _run_notification_task(
+        registration: Registration,
+        current_player_nation: str,
+        current_player_turn: int,
+        now: float
+) -> bool:
+    """ Notify the registration if it is on turn and a notification is due, return whether its state changed """
+
+    name = registration.name
+    chat_id = registration.chatid
+    last_notification_turn = registration.last_notification_turn
+
+    if current_player_nation != registration.nation:
+        _logger.debug("Not players turn, skipping. checked=%s, turn=%s", current_player_nation, registration.nation)
+        return False
     
     if current_player_turn > last_notification_turn:
         _logger.debug("Turn number changed, resetting turn notification state")
-        job_data["last_notification_turn"] = current_player_turn
+        registration.last_notification_turn = current_player_turn
         current_turn_notification_count = 0
-        next_notification_time = datetime.fromtimestamp(0).isoformat()
+        next_notification_at = 0.0
     else:
-        current_turn_notification_count = job_data.get("current_turn_notification_count", 0)        
-        next_notification_time = job_data.get("next_notification_time", datetime.fromtimestamp(0).isoformat())
-        
-    now = datetime.now()
+        current_turn_notification_count = registration.current_turn_notification_count
+        next_notification_at = registration.next_notification_at
     
-    if now > datetime.fromisoformat(next_notification_time):
-        gameid = job_data["gameid"]
+    if now > next_notification_at:
+        gameid = registration.gameid
         next_reminder = timedelta(seconds=_get_notification_time_difference_seconds(current_turn_notification_count + 1))
-        job_data["next_notification_time"] = (now + next_reminder).isoformat()
-        job_data["current_turn_notification_count"] = current_turn_notification_count + 1
+        registration.next_notification_at = now + next_reminder.total_seconds()
+        registration.current_turn_notification_count = current_turn_notification_count + 1
         notification_text = (
             f"It's your turn, {current_player_nation}! "
             f"Game: <b>{name}</b>, turn: {current_player_turn}. <a href='{get_game_link(gameid)}'>OPEN</a>. "
             f"Next reminder in {next_reminder}."
         )
         
-        await context.bot.send_message(
-            chat_id=context.job.chat_id,
-            text=notification_text,
-            parse_mode=ParseMode.HTML
-        )
-    else:
-        _logger.debug("Already notified, skipping")
+        deliver(chat_id, notification_text)
+        _NOTIFICATIONS.inc(urlsplit(registration.server).netloc)
+        return True
+
+    _logger.debug("Already notified, skipping")
+    return registration.last_notification_turn != last_notification_turn
 
 def _get_notification_time_difference_seconds(notification_number: int) -> int:
     """ Return notification time difference in seconds """
@@ -102,9 +436,32 @@ def _get_notification_time_difference_seconds(notification_number: int) -> int:
     return difference_minutes * 60
 
 def _remove_job(context: CallbackContext) -> None:
-        _logger.warning("Removing orphan job user_id=%s, name=%s", context.job.user_id, context.job.data)
+        _logger.warning("Removing orphan job name=%s", context.job.name)
         context.job.enabled = False
         context.job.schedule_removal()
 
 def get_game_link(gameid: str) -> str:
     return f"https://unciv.app/multiplayer?id={gameid}"
+
+
+class _GameSnapshot:
+    """ Current player and turn of a game and the earliest next reminder of its subscribers on turn (epoch seconds) """
+
+    __slots__ = ("nation", "turn", "next_notification_at")
+
+    nation: str
+    turn: int
+    next_notification_at: float
+
+    def __init__(self, nation: str, turn: int, next_notification_at: float):
+        self.nation = nation
+        self.turn = turn
+        self.next_notification_at = next_notification_at
+
+    def matches(self, nation: str, turn: int, now: float) -> bool:
+        """ Whether the game is still in this state and no reminder is due """
+
+        return turn == self.turn and now < self.next_notification_at and nation == self.nation
+
+    def reminder_due(self, now: float) -> float | None:
+        return None if self.next_notification_at == math.inf else self.next_notification_at - now
@@ -1,4 +1,10 @@
+from __future__ import annotations
+
 import enum
+import functools
+import sys
+from datetime import datetime
+from typing import Any, Literal
 
 import pydantic
 
@@ -6,6 +12,65 @@ import pydantic
 class Config(pydantic.BaseSettings):
     CHAT_TOKEN: str
 
+    UPDATE_MODE: Literal["polling", "webhook"] = "polling"
+    CONCURRENT_UPDATES: int = 1
+    WEBHOOK_LISTEN: str = "127.0.0.1"
+    WEBHOOK_PORT: int = 8443
+    WEBHOOK_PATH: str = "/telegram"
+    WEBHOOK_URL: str | None = None
+    WEBHOOK_SECRET: str | None = None
+
+    HTTP_LIMIT: int = 100
+    HTTP_LIMIT_PER_HOST: int = 20
+    HTTP_DNS_CACHE_TTL: int = 300
+    HTTP_KEEPALIVE_TIMEOUT: float = 30
+    HTTP_CONNECT_TIMEOUT: float = 10
+    HTTP_READ_TIMEOUT: float = 30
+
+    DECODE_EXECUTOR: Literal["thread", "process"] = "thread"
+    DECODE_WORKERS: int = 2
+    DECODE_QUEUE_SIZE: int = 16
+    JSON_BACKEND: Literal["auto", "orjson", "msgspec", "json"] = "auto"
+    STREAMING_DECODE: bool = False
+
+    FETCH_CONCURRENCY_PER_HOST: int = 8
+    FETCH_SLOW_SECONDS: float = 5
+    CIRCUIT_FAILURE_THRESHOLD: int = 5
+    CIRCUIT_OPEN_SECONDS: float = 30
+    CIRCUIT_MAX_OPEN_SECONDS: float = 900
+    POLL_JITTER: float = 0.1
+    ADAPTIVE_POLLING: bool = False
+    POLL_MAX_PERIOD: float = 900
+    PROBE_BEFORE_DOWNLOAD: bool = True
+    GAME_SOURCE: Literal["poll", "long-poll"] = "poll"
+    LONG_POLL_TIMEOUT: float = 60
+    LONG_POLL_CONCURRENCY_PER_HOST: int = 16
+    GAMEFILE_CACHE_TTL: float = 60
+    GAMEFILE_CACHE_BYTES: int = 64 * 1024 * 1024
+    POLL_WORKERS: int = 0
+    WORKER_SHUTDOWN_TIMEOUT: float = 5
+
+    DELIVERY_RATE: float = 25
+    DELIVERY_CHAT_RATE: float = 1
+    DELIVERY_GROUP_RATE: float = 0.33
+    DELIVERY_CONCURRENCY: int = 8
+    DELIVERY_SHUTDOWN_TIMEOUT: float = 5
+
+    METRICS_HOST: str = "127.0.0.1"
+    METRICS_PORT: int | None = None
+
+    STORAGE_PATH: str = "/data/storage.sqlite3"
+    LEGACY_STORAGE_PATH: str = "/data/storage.pickle"
+    STORAGE_FLUSH_INTERVAL: float = 60
+
+    STARTUP_BATCH_SIZE: int = 100
+    STARTUP_PRUNE_MISSING_GAMES: bool = False
+
+
+@functools.cache
+def get_config() -> Config:
+    return Config()
+
 
 class RegistrationStates(enum.IntEnum):
     START = enum.auto()
@@ -19,3 +84,79 @@ class RegistrationStates(enum.IntEnum):
 class UnregistrationStates(enum.IntEnum):
     START = enum.auto()
     NAME = enum.auto()
+
+
+class Registration:
+    """ Turn notification registered by a chat, along with the notification state of the current turn """
+
+    __slots__ = (
+        "name", "server", "gameid", "nation", "chatid", "userid", "period", "job_name",
+        "last_notification_turn", "current_turn_notification_count", "next_notification_at"
+    )
+
+    name: str
+    server: str
+    gameid: str
+    nation: str
+    chatid: int
+    # User whose user_data stores the registration, differs from the chat in group chats
+    userid: int | None
+    period: float
+    job_name: str | None
+    last_notification_turn: int
+    current_turn_notification_count: int
+    # Epoch seconds, 0 when the registration was not notified yet
+    next_notification_at: float
+
+    def __init__(
+            self,
+            name: str,
+            server: str,
+            gameid: str,
+            nation: str,
+            chatid: int,
+            period: float,
+            userid: int | None = None,
+            job_name: str | None = None,
+            last_notification_turn: int = -1,
+            current_turn_notification_count: int = 0,
+            next_notification_at: float = 0.0
+    ):
+        self.name = name
+        # Shared by all registrations of the same server, game or nation
+        self.server = sys.intern(server)
+        self.gameid = sys.intern(gameid)
+        self.nation = sys.intern(nation)
+        self.chatid = chatid
+        self.userid = userid
+        self.period = period
+        self.job_name = job_name
+        self.last_notification_turn = last_notification_turn
+        self.current_turn_notification_count = current_turn_notification_count
+        self.next_notification_at = next_notification_at
+
+    @property
+    def key(self) -> tuple[int, str]:
+        return self.chatid, self.name
+
+    @property
+    def game_key(self) -> tuple[str, str]:
+        return self.server, self.gameid
+
+    @property
+    def owner_id(self) -> int:
+        return self.chatid if self.userid is None else self.userid
+
+    @classmethod
+    def from_dict(cls, data: dict[str, Any]) -> Registration:
+        registration = cls(**{field: data[field] for field in cls.__slots__ if field in data})
+        # Older versions stored the time of the next reminder as an ISO string
+        if data.get("next_notification_time", None):
+            registration.next_notification_at = datetime.fromisoformat(data["next_notification_time"]).timestamp()
+        return registration
+
+    def as_dict(self) -> dict[str, Any]:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def __repr__(self) -> str:
+        return f"Registration(chatid={self.chatid}, name={self.name!r}, server={self.server!r}, gameid={self.gameid!r})"
@@ -0,0 +1,247 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from logging import getLogger
+
+from telegram import Bot
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import RetryAfter
+
+from datatypes import get_config
+from metrics import Gauge, Histogram
+
+_logger = getLogger(__name__)
+
+_dispatcher: _Dispatcher | None = None
+
+# Joins the messages queued for a chat into one
+_SEPARATOR = "\n\n"
+
+_SEND_SECONDS = Histogram("unciv_send_seconds", "Duration of sending messages to Telegram", ("result",))
+Gauge(
+    "unciv_delivery_queued_chats", "Chats with messages waiting to be sent",
+    lambda: _dispatcher.queued if _dispatcher else 0
+)
+
+
+def start_delivery(bot: Bot) -> None:
+    """ Start sending the enqueued messages with the bot """
+
+    global _dispatcher
+
+    if _dispatcher is None:
+        config = get_config()
+        _dispatcher = _Dispatcher(
+            bot, config.DELIVERY_RATE, config.DELIVERY_CHAT_RATE, config.DELIVERY_GROUP_RATE, config.DELIVERY_CONCURRENCY
+        )
+        _dispatcher.start()
+
+
+async def stop_delivery() -> None:
+    global _dispatcher
+
+    if _dispatcher is not None:
+        await _dispatcher.stop(get_config().DELIVERY_SHUTDOWN_TIMEOUT)
+        _dispatcher = None
+
+
+def deliver(chat_id: int, text: str) -> None:
+    """
+    Enqueue an HTML message for the chat and return immediately. Messages still waiting for the chat when it is its
+    turn to be sent are merged into one.
+    """
+
+    if _dispatcher is None:
+        raise RuntimeError("Message delivery is not running")
+    _dispatcher.enqueue(chat_id, text)
+
+
+class _TokenBucket:
+    """ Allows `rate` events per second on average with bursts of up to `capacity` events """
+
+    _rate: float
+    _capacity: float
+    _tokens: float
+    _updated: float
+
+    def __init__(self, rate: float, capacity: float):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def delay(self) -> float:
+        """ Seconds until a token is available """
+
+        self._refill()
+        return max(0.0, (1 - self._tokens) / self._rate)
+
+    def take(self) -> None:
+        self._refill()
+        self._tokens -= 1
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self._capacity
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+
+
+class _Dispatcher:
+    """
+    Sends queued messages in the order their chats were enqueued, within a global and a per-chat rate limit, which is
+    lower for group chats. When Telegram answers with a flood control error, all sending is paused for the requested
+    time and the message is put back to the front of the queue.
+    """
+
+    _MAX_CHAT_BUCKETS = 1000
+
+    _bot: Bot
+    _pending: OrderedDict[int, list[str]]
+    _global: _TokenBucket
+    _chat_rate: float
+    _group_rate: float
+    _chats: dict[int, _TokenBucket]
+    _slots: asyncio.Semaphore
+    _wakeup: asyncio.Event
+    _paused_until: float
+    _worker: asyncio.Task | None
+    _sending: set[asyncio.Task]
+
+    def __init__(self, bot: Bot, rate: float, chat_rate: float, group_rate: float, concurrency: int):
+        self._bot = bot
+        self._pending = OrderedDict()
+        self._global = _TokenBucket(rate, rate)
+        self._chat_rate = chat_rate
+        self._group_rate = group_rate
+        self._chats = dict()
+        self._slots = asyncio.Semaphore(concurrency)
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self._worker = None
+        self._sending = set()
+
+    def start(self) -> None:
+        self._worker = asyncio.create_task(self._run(), name="delivery")
+
+    async def stop(self, timeout: float) -> None:
+        """ Try to send the remaining messages within the timeout, then stop """
+
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._sending) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        if self._pending:
+            _logger.warning("Dropping undelivered messages for %s chats", len(self._pending))
+
+        self._worker.cancel()
+        for task in list(self._sending):
+            task.cancel()
+        await asyncio.gather(self._worker, *self._sending, return_exceptions=True)
+
+    @property
+    def queued(self) -> int:
+        return len(self._pending)
+
+    def enqueue(self, chat_id: int, text: str) -> None:
+        self._pending.setdefault(chat_id, list()).append(text)
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            await self._slots.acquire()
+
+            chat_id, delay = self._next_chat()
+            delay = max(delay, self._paused_until - time.monotonic(), self._global.delay())
+            if delay > 0:
+                self._slots.release()
+                await self._sleep(delay)
+                continue
+
+            texts = self._take_texts(chat_id)
+            self._global.take()
+            self._get_chat_bucket(chat_id).take()
+
+            task = asyncio.create_task(self._send(chat_id, texts))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    def _take_texts(self, chat_id: int) -> list[str]:
+        """
+        Dequeue the first texts of the chat fitting into a single message together, the others stay queued behind
+        the other chats
+        """
+
+        texts = self._pending.pop(chat_id)
+        length = len(texts[0])
+        count = 1
+        while count < len(texts) and length + len(_SEPARATOR) + len(texts[count]) <= MessageLimit.MAX_TEXT_LENGTH:
+            length += len(_SEPARATOR) + len(texts[count])
+            count += 1
+
+        if count < len(texts):
+            self._pending[chat_id] = texts[count:]
+        return texts[:count]
+
+    def _next_chat(self) -> tuple[int | None, float]:
+        """ Return the first queued chat allowed to be sent to, or the time until one is """
+
+        if not self._pending:
+            return None, float("inf")
+
+        shortest = float("inf")
+        for chat_id in self._pending:
+            delay = self._get_chat_bucket(chat_id).delay()
+            if delay == 0:
+                return chat_id, 0.0
+            shortest = min(shortest, delay)
+
+        return None, shortest
+
+    async def _sleep(self, delay: float) -> None:
+        """ Sleep for the delay or until a message is enqueued """
+
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), None if delay == float("inf") else delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _send(self, chat_id: int, texts: list[str]) -> None:
+        started = time.perf_counter()
+        result = "error"
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=_SEPARATOR.join(texts), parse_mode=ParseMode.HTML)
+            result = "sent"
+        except RetryAfter as err:
+            result = "retry"
+            retry_after = err.retry_after
+            if isinstance(retry_after, timedelta):
+                retry_after = retry_after.total_seconds()
+
+            _logger.warning("Flood control exceeded, pausing delivery for %s seconds", retry_after)
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            self._pending[chat_id] = texts + self._pending.get(chat_id, list())
+            self._pending.move_to_end(chat_id, last=False)
+        except Exception:
+            _logger.exception("Sending message failed chat_id=%s", chat_id)
+        finally:
+            _SEND_SECONDS.observe(time.perf_counter() - started, result)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _get_chat_bucket(self, chat_id: int) -> _TokenBucket:
+        if chat_id not in self._chats:
+            if len(self._chats) >= self._MAX_CHAT_BUCKETS:
+                self._chats = {
+                    chat: bucket for chat, bucket in self._chats.items() if chat in self._pending or not bucket.is_full()
+                }
+            # Groups and channels have negative ids
+            self._chats[chat_id] = _TokenBucket(self._group_rate if chat_id < 0 else self._chat_rate, 1)
+        return self._chats[chat_id]
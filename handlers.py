@@ -1,37 +1,54 @@
+import functools
+import hashlib
 from logging import getLogger
+from typing import Any, Awaitable, Callable
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ParseMode
 from telegram.ext import ContextTypes, ConversationHandler
 
-from data import has_games, get_game, create_notify_job, get_game_link, list_games
-from datatypes import RegistrationStates, UnregistrationStates
-from reader import gamefile
+from data import get_registration, create_notify_job, get_game_link, list_chat_registrations, remove_registration
+from datatypes import RegistrationStates, UnregistrationStates, Registration
+from metrics import Histogram
+from reader import gamefile, GamefileError, ServerUnavailableError
 
 
 __all__ = [
     "list_registrations", "unregister", "start", "register", "register_name", "register_server", "register_cancel",
     "register_nation_failed", "register_gameid", "register_name_failed", "register_server_failed",
     "register_nation_name", "register_gameid_failed", "register_period_failed", "register_period", "unregister_id",
-    "unregister_cancel"
+    "unregister_cancel", "subscribe_game", "subscribe_gameid", "subscribe_period"
 ]
 
 
 _logger = getLogger(__name__)
 
+_HANDLER_SECONDS = Histogram("unciv_handler_seconds", "Duration of update handlers", ("handler",))
 
+
+def _instrumented(handler: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        with _HANDLER_SECONDS.time(handler.__name__):
+            return await handler(update, context)
+
+    return wrapper
+
+
+@_instrumented
 async def list_registrations(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not has_games(context.user_data):
+    games = list_chat_registrations(update.effective_chat.id)
+    if not games:
         await context.bot.send_message(chat_id=update.effective_chat.id, text="You have no games registered")
         return
 
     rows = list()
-    for game in context.user_data["games"]:
-        name = game["name"]
-        nation = game["nation"]
-        server = game["server"]
-        gameid = game["gameid"]
-        period = game["period"]
+    for game in games:
+        name = game.name
+        nation = game.nation
+        server = game.server
+        gameid = game.gameid
+        period = game.period
 
         row = [f"<b># {name}</b>",
                f"    Nation: {nation}",
@@ -49,10 +66,11 @@ async def list_registrations(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 
+@_instrumented
 async def unregister(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    games = list_games(context.user_data)
+    games = list_chat_registrations(update.effective_chat.id)
     
-    keyboard = [[InlineKeyboardButton(game["name"], callback_data=game["gameid"])] for game in games]
+    keyboard = [[InlineKeyboardButton(game.name, callback_data=_get_name_token(game.name))] for game in games]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Choose server (or enter your own URL):", reply_markup=reply_markup)
 
@@ -65,10 +83,14 @@ async def unregister(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return UnregistrationStates.NAME
 
 
+@_instrumented
 async def unregister_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    gameid = update.callback_query.data if update.callback_query else update.message.text
-
-    game = get_game(context.user_data, lambda g: g["gameid"] == gameid)
+    if update.callback_query:
+        token = update.callback_query.data
+        games = list_chat_registrations(update.effective_chat.id)
+        game = next((game for game in games if _get_name_token(game.name) == token), None)
+    else:
+        game = get_registration(update.effective_chat.id, update.message.text)
     if not game:
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
@@ -76,10 +98,8 @@ async def unregister_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return UnregistrationStates.NAME
 
-    job, = context.job_queue.get_jobs_by_name(game["job_name"])
-    job.enabled = False
-    context.job_queue.scheduler.remove_job(job.job.id)
-    context.user_data["games"].remove(game)
+    # In a group chat, the game may have been registered by another member
+    remove_registration(context.application, game)
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -89,14 +109,23 @@ async def unregister_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+def _get_name_token(name: str) -> str:
+    """ Callback data identifying the game name, Telegram limits callback data to 64 bytes but not the names """
+
+    return hashlib.blake2b(name.encode("utf8"), digest_size=8).hexdigest()
+
+
+@_instrumented
 async def unregister_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Cancelling the unregistration process. Yay!")
     return ConversationHandler.END
 
 
+@_instrumented
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     commands = [
         "/register\tSubscribe a new watcher",
+        "/subscribe_game\tSubscribe all players of a game to this chat",
         "/unregister\tRemove a watcher",
         "/list\tList all watchers"
     ]
@@ -107,6 +136,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+@_instrumented
 async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -119,10 +149,11 @@ async def register(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return RegistrationStates.NAME
 
 
+@_instrumented
 async def register_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     name = update.message.text
 
-    if get_game(context.user_data, lambda g: g["name"] == name):
+    if get_registration(update.effective_chat.id, name):
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Name already in use, try a different one"
@@ -134,6 +165,7 @@ async def register_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return RegistrationStates.SERVER
 
 
+@_instrumented
 async def register_name_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -143,6 +175,7 @@ async def register_name_failed(update: Update, context: ContextTypes.DEFAULT_TYP
     return RegistrationStates.NAME
 
 
+@_instrumented
 async def register_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
     url = update.callback_query.data if update.callback_query else update.message.text
     context.user_data['registration']['server'] = url
@@ -150,28 +183,37 @@ async def register_server(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return RegistrationStates.GAME_ID
 
 
+@_instrumented
 async def register_server_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="URL invalid. Try again.")
     await _ask_server(update, context)
     return RegistrationStates.SERVER
 
 
+@_instrumented
 async def register_gameid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['registration']['gameid'] = update.message.text
-    await _ask_nation(update, context)
-    return RegistrationStates.NATION
+    return await _ask_nation(update, context)
 
 
+@_instrumented
 async def register_gameid_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Game ID has incorrect format. Try again.")
     await _ask_gameid(update, context)
     return RegistrationStates.GAME_ID
 
 
+@_instrumented
 async def register_nation_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with gamefile(context.user_data['registration']['server'], context.user_data['registration']['gameid']) as f:
-        players = f.get_value("gameParameters", "players")
-        civilizations = f.get_value("civilizations")
+    registration = context.user_data['registration']
+    try:
+        async with gamefile(
+                registration['server'], registration['gameid'], keys=("gameParameters", "civilizations")
+        ) as f:
+            players = f.get_value("gameParameters", "players")
+            civilizations = f.get_value("civilizations")
+    except (ServerUnavailableError, GamefileError) as err:
+        return await _game_unavailable(update, context, err)
 
     userInput = update.callback_query.data if update.callback_query else update.message.text
     player = [
@@ -195,25 +237,19 @@ async def register_nation_name(update: Update, context: ContextTypes.DEFAULT_TYP
     return RegistrationStates.PERIOD
 
 
+@_instrumented
 async def register_nation_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
         text="Supplied string is not a nation name nor it is a Client ID. Try again."
     )
-    await _ask_nation(update, context)
-    return RegistrationStates.NATION
+    return await _ask_nation(update, context)
 
 
+@_instrumented
 async def register_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        period = float(update.message.text)
-    except ValueError:
-        period = None
-    if not period or period < 10:
-        await context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="Period must be a number greater or equal to 10"
-        )
+    period = await _read_period(update, context)
+    if period is None:
         return RegistrationStates.PERIOD
 
     await _finish_registration(period, update, context)
@@ -221,6 +257,7 @@ async def register_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 
+@_instrumented
 async def register_period_failed(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -230,6 +267,84 @@ async def register_period_failed(update: Update, context: ContextTypes.DEFAULT_T
     return RegistrationStates.PERIOD
 
 
+@_instrumented
+async def subscribe_game(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await context.bot.send_message(
+        chat_id=update.effective_chat.id,
+        text="Subscribing all players of a game to this chat... You can always /cancel to abort"
+    )
+
+    context.user_data['registration'] = dict()
+
+    await _ask_name(update, context)
+    return RegistrationStates.NAME
+
+
+@_instrumented
+async def subscribe_gameid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    registration = context.user_data['registration']
+    registration['gameid'] = update.message.text
+
+    try:
+        async with gamefile(registration['server'], registration['gameid'], keys=("civilizations",)) as f:
+            civilizations = f.get_value("civilizations")
+    except (ServerUnavailableError, GamefileError) as err:
+        return await _game_unavailable(update, context, err)
+
+    nations = [civ["civName"] for civ in civilizations if civ.get("playerType", "").lower() == "human"]
+    if not nations:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="The game has no human players. Try again."
+        )
+        await _ask_gameid(update, context)
+        return RegistrationStates.GAME_ID
+
+    registration['nations'] = nations
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=f"Players: {', '.join(nations)}")
+    await _ask_period(update, context)
+    return RegistrationStates.PERIOD
+
+
+@_instrumented
+async def subscribe_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    period = await _read_period(update, context)
+    if period is None:
+        return RegistrationStates.PERIOD
+
+    chat_id = update.effective_chat.id
+    registration_data = context.user_data["registration"]
+    del context.user_data["registration"]
+
+    # All registrations of the game share its single poll job
+    subscribed = list()
+    for nation in registration_data["nations"]:
+        name = f"{registration_data['name']} - {nation}"
+        if get_registration(chat_id, name):
+            continue
+
+        registration = Registration(
+            name=name,
+            server=registration_data["server"],
+            gameid=registration_data["gameid"],
+            nation=nation,
+            chatid=chat_id,
+            userid=update.effective_user.id,
+            period=period
+        )
+        registration.job_name = await create_notify_job(context.job_queue, registration)
+        context.user_data.setdefault("games", list()).append(registration)
+        subscribed.append(nation)
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=f"Subscribed {len(subscribed)} players: {', '.join(subscribed)}. You can always /unregister them"
+    )
+
+    return ConversationHandler.END
+
+
+@_instrumented
 async def register_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await context.bot.send_message(chat_id=update.effective_chat.id, text="Cancelling the registration process. Your loss.")
     context.user_data['registration'] = dict()
@@ -256,9 +371,16 @@ async def _ask_gameid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def _ask_nation(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    async with gamefile(context.user_data['registration']['server'], context.user_data['registration']['gameid']) as f:
-        civilizations = f.get_value("civilizations")
+async def _ask_nation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> RegistrationStates:
+    registration = context.user_data['registration']
+    try:
+        # Same keys as register_nation_name, so the file parsed here is reused there
+        async with gamefile(
+                registration['server'], registration['gameid'], keys=("gameParameters", "civilizations")
+        ) as f:
+            civilizations = f.get_value("civilizations")
+    except (ServerUnavailableError, GamefileError) as err:
+        return await _game_unavailable(update, context, err)
 
     mapCivNameToPlayerId = {
         civ["civName"]: civ["playerId"]
@@ -269,6 +391,20 @@ async def _ask_nation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [[InlineKeyboardButton(civName, callback_data=playerId) for civName, playerId in mapCivNameToPlayerId.items()]]
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Choose civilization:", reply_markup=reply_markup)
+    return RegistrationStates.NATION
+
+
+async def _game_unavailable(update: Update, context: ContextTypes.DEFAULT_TYPE, err: Exception) -> RegistrationStates:
+    if isinstance(err, GamefileError) and err.status == 404:
+        text = "Game not found. Try again."
+    elif isinstance(err, GamefileError):
+        text = f"Server refused the game file with status {err.status}. Try again."
+    else:
+        text = "Server is not available. Try again."
+
+    await context.bot.send_message(chat_id=update.effective_chat.id, text=text)
+    await _ask_gameid(update, context)
+    return RegistrationStates.GAME_ID
 
 
 async def _ask_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -278,22 +414,44 @@ async def _ask_period(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
+async def _read_period(update: Update, context: ContextTypes.DEFAULT_TYPE) -> float | None:
+    try:
+        period = float(update.message.text)
+    except ValueError:
+        period = None
+    if not period or period < 10:
+        await context.bot.send_message(
+            chat_id=update.effective_chat.id,
+            text="Period must be a number greater or equal to 10"
+        )
+        return None
+
+    return period
+
+
 async def _finish_registration(period: float, update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
 
     registration_data = context.user_data["registration"]
     del context.user_data["registration"]
 
-    registration_data["chatid"] = chat_id
-    registration_data["period"] = period
+    registration = Registration(
+        name=registration_data["name"],
+        server=registration_data["server"],
+        gameid=registration_data["gameid"],
+        nation=registration_data["nation"],
+        chatid=chat_id,
+        userid=update.effective_user.id,
+        period=period
+    )
 
-    job = await create_notify_job(context.job_queue, registration_data)
+    job_name = await create_notify_job(context.job_queue, registration)
 
     if "games" not in context.user_data:
         context.user_data["games"] = list()
 
-    registration_data["job_name"] = job.name
-    context.user_data["games"].append(registration_data)
+    registration.job_name = job_name
+    context.user_data["games"].append(registration)
 
     await context.bot.send_message(
         chat_id=update.effective_chat.id,
@@ -0,0 +1,152 @@
+"""
+Webhook ingress receiving Telegram updates over HTTP instead of polling `getUpdates`.
+
+Running this module posts a synthetic text message update to a running webhook, e.g. to try commands locally
+without Telegram:
+
+    python ingress.py /start --chat-id 1 --url http://127.0.0.1:8443/telegram --secret $WEBHOOK_SECRET
+"""
+
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hmac
+import json
+import signal
+import time
+from logging import getLogger
+
+import aiohttp
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from datatypes import get_config
+from metrics import Counter
+
+_logger = getLogger(__name__)
+
+_SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+_runner: web.AppRunner | None = None
+
+_WEBHOOK_UPDATES = Counter("unciv_webhook_updates_total", "Updates received by the webhook", ("result",))
+
+
+async def serve_webhook(application: Application) -> None:
+    """
+    Run the application with updates received by the webhook until SIGINT or SIGTERM, calling the post_init,
+    post_stop and post_shutdown callbacks like `Application.run_polling` does. The application must be built without
+    an updater.
+    """
+
+    config = get_config()
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+
+        await start_webhook(application, config.WEBHOOK_LISTEN, config.WEBHOOK_PORT, config.WEBHOOK_PATH)
+        if config.WEBHOOK_URL:
+            await application.bot.set_webhook(
+                config.WEBHOOK_URL, secret_token=config.WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+            )
+            _logger.info("Registered webhook %s", config.WEBHOOK_URL)
+
+        await application.start()
+        try:
+            await stopped.wait()
+        finally:
+            await stop_webhook()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+async def start_webhook(application: Application, host: str, port: int, path: str) -> None:
+    """ Accept updates POSTed to http://host:port/path and put them to the update queue of the application """
+
+    global _runner
+
+    app = web.Application()
+    app["application"] = application
+    app.router.add_post(path, _handle_update)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    _logger.info("Receiving updates on http://%s:%s%s", host, port, path)
+
+
+async def stop_webhook() -> None:
+    global _runner
+
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+async def _handle_update(request: web.Request) -> web.Response:
+    application: Application = request.app["application"]
+
+    secret = get_config().WEBHOOK_SECRET
+    if secret and not hmac.compare_digest(request.headers.get(_SECRET_HEADER, ""), secret):
+        _WEBHOOK_UPDATES.inc("forbidden")
+        return web.Response(status=403)
+
+    try:
+        update = Update.de_json(await request.json(), application.bot)
+    except (ValueError, TypeError, KeyError):
+        _logger.debug("Rejecting malformed update", exc_info=True)
+        _WEBHOOK_UPDATES.inc("malformed")
+        return web.Response(status=400)
+
+    # Telegram only waits for the acknowledgement, the update is handled by the application in the background
+    await application.update_queue.put(update)
+    _WEBHOOK_UPDATES.inc("accepted")
+    return web.Response()
+
+
+def _build_message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": "Test"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+
+async def _post_update(url: str, secret: str | None, update: dict) -> int:
+    headers = {_SECRET_HEADER: secret} if secret else dict()
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=json.dumps(update), headers=headers) as response:
+            return response.status
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("text", help="text of the message, e.g. a command")
+    parser.add_argument("--chat-id", type=int, default=1, help="chat and user the message is sent from")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/telegram", help="URL of the webhook")
+    parser.add_argument("--secret", default=None, help="secret token of the webhook")
+    args = parser.parse_args()
+
+    update = _build_message_update(int(time.time() * 1000) % 2 ** 31, args.chat_id, args.text)
+    print(asyncio.run(_post_update(args.url, args.secret, update)))
+
+
+if __name__ == "__main__":
+    main()
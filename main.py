@@ -1,13 +1,20 @@
+import asyncio
+import functools
 import logging
-from pathlib import Path
+import time
 
 from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters, \
-    PicklePersistence, Application, CallbackQueryHandler
+    Application, CallbackQueryHandler
 from telegram.ext.filters import UpdateType
 
-from data import create_notify_job, has_games
-from datatypes import Config, RegistrationStates, UnregistrationStates
+from data import restore_registrations, restore_notify_jobs, stop_watching, report_game_state
+from datatypes import RegistrationStates, UnregistrationStates, get_config
+from delivery import start_delivery, stop_delivery
+from metrics import start_metrics_server, stop_metrics_server, instrument_job_queue
 from handlers import *
+from reader import close_session, shutdown_decoder
+from storage import SqlitePersistence
+from workers import start_workers, stop_workers
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -16,33 +23,67 @@ logging.basicConfig(
 
 _logger = logging.getLogger(__name__)
 
-config = Config()
+config = get_config()
 
 id_filter = filters.Regex(r"^[a-zA-Z0-9]{8}-[a-zA-Z0-9]{4}-[a-zA-Z0-9]{4}-[a-zA-Z0-9]{4}-[a-zA-Z0-9]{12}$")
 name_filter = filters.Regex(r"^[a-zA-Z0-9_\- ]+$")
+url_filter = filters.Regex("^((http|https)://)[-a-zA-Z0-9@:%._\\+~#?&//=]{2,256}\\.[a-z]{2,6}\\b([-a-zA-Z0-9@:%._\\+~#?&//=]*)$")
 
 
 async def initialize_jobs(app: Application):
+    # The HTTP session, and aiohttp with it, is loaded by the first game file request
+    start_delivery(app.bot)
+    if config.METRICS_PORT is not None:
+        await start_metrics_server(config.METRICS_HOST, config.METRICS_PORT)
+        instrument_job_queue(app.job_queue)
+    if config.POLL_WORKERS > 0:
+        start_workers(config.POLL_WORKERS, functools.partial(report_game_state, app))
+
     _logger.info("Initializing jobs from persistance store")
-    for chat_id, user_data in app.user_data.items():
-        if has_games(user_data):
-            for game in user_data["games"]:
-                _logger.debug("initializing %s", game)
-                await create_notify_job(app.job_queue, game)
-        else:
-            _logger.debug("chat_id %s has no games, skipping", chat_id)
+    started = time.perf_counter()
+    count = restore_registrations(app)
+    _logger.info("Restored %s registrations in %.3f s", count, time.perf_counter() - started)
+
+    # Poll jobs are scheduled once the application runs, so it starts serving commands right away
+    app.job_queue.run_once(restore_notify_jobs, when=0, name="restore-jobs")
+
+
+async def stop(app: Application):
+    stop_watching()
+    await stop_workers()
+    # The bot is still usable here, unlike in post_shutdown
+    await stop_delivery()
+
+
+async def shutdown(app: Application):
+    await stop_metrics_server()
+    await close_session()
+    shutdown_decoder()
 
 
 if __name__ == '__main__':
-    persistence = PicklePersistence(str(Path("/data/storage.pickle")))
+    persistence = SqlitePersistence(
+        config.STORAGE_PATH,
+        legacy_filepath=config.LEGACY_STORAGE_PATH,
+        update_interval=config.STORAGE_FLUSH_INTERVAL
+    )
 
-    application = ApplicationBuilder().token(
+    builder = ApplicationBuilder().token(
         config.CHAT_TOKEN
     ).persistence(
         persistence
+    ).concurrent_updates(
+        config.CONCURRENT_UPDATES
     ).post_init(
         initialize_jobs
-    ).build()
+    ).post_stop(
+        stop
+    ).post_shutdown(
+        shutdown
+    )
+    if config.UPDATE_MODE == "webhook":
+        builder.updater(None)
+    application = builder.build()
 
     start_handler = CommandHandler(['start', 'help'], start, filters=~UpdateType.EDITED_MESSAGE)
     application.add_handler(start_handler)
@@ -61,7 +102,7 @@ if __name__ == '__main__':
             RegistrationStates.SERVER: [
                 CommandHandler("cancel", register_cancel),
                 CallbackQueryHandler(register_server),
-                MessageHandler(filters.TEXT & filters.Regex("^((http|https)://)[-a-zA-Z0-9@:%._\\+~#?&//=]{2,256}\\.[a-z]{2,6}\\b([-a-zA-Z0-9@:%._\\+~#?&//=]*)$"), register_server),
+                MessageHandler(filters.TEXT & url_filter, register_server),
                 MessageHandler(filters.ALL, register_server_failed)
             ],
             RegistrationStates.GAME_ID: [
@@ -85,6 +126,36 @@ if __name__ == '__main__':
 
     application.add_handler(register_handler)
 
+    subscribe_handler = ConversationHandler(
+        entry_points=[CommandHandler("subscribe_game", subscribe_game)],
+        states={
+            RegistrationStates.NAME: [
+                CommandHandler("cancel", register_cancel),
+                MessageHandler(filters.TEXT & name_filter, register_name),
+                MessageHandler(filters.ALL, register_name_failed)
+            ],
+            RegistrationStates.SERVER: [
+                CommandHandler("cancel", register_cancel),
+                CallbackQueryHandler(register_server),
+                MessageHandler(filters.TEXT & url_filter, register_server),
+                MessageHandler(filters.ALL, register_server_failed)
+            ],
+            RegistrationStates.GAME_ID: [
+                CommandHandler("cancel", register_cancel),
+                MessageHandler(filters.TEXT & id_filter, subscribe_gameid),
+                MessageHandler(filters.ALL, register_gameid_failed)
+            ],
+            RegistrationStates.PERIOD: [
+                CommandHandler("cancel", register_cancel),
+                MessageHandler(filters.TEXT, subscribe_period),
+                MessageHandler(filters.ALL, register_period_failed)
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", register_cancel)],
+    )
+
+    application.add_handler(subscribe_handler)
+
     unregister_handler = ConversationHandler(
         entry_points=[CommandHandler("unregister", unregister)],
         states={
@@ -98,4 +169,9 @@ if __name__ == '__main__':
 
     application.add_handler(unregister_handler)
 
-    application.run_polling()
+    if config.UPDATE_MODE == "webhook":
+        from ingress import serve_webhook
+
+        asyncio.run(serve_webhook(application))
+    else:
+        application.run_polling()
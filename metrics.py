@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import bisect
+import contextlib
+import time
+from datetime import datetime
+from logging import getLogger
+from typing import TYPE_CHECKING, Callable, Iterator
+
+if TYPE_CHECKING:
+    from aiohttp import web
+    from apscheduler.events import JobSubmissionEvent
+    from telegram.ext import JobQueue
+
+_logger = getLogger(__name__)
+
+_metrics: list[_Metric] = list()
+_runner: web.AppRunner | None = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+async def start_metrics_server(host: str, port: int) -> None:
+    """ Serve all metrics in the Prometheus text format on http://host:port/metrics """
+
+    global _runner
+
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    _logger.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+
+async def stop_metrics_server() -> None:
+    global _runner
+
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
+
+
+def instrument_job_queue(job_queue: JobQueue) -> None:
+    """ Observe how late the jobs of the queue start compared to their scheduled run time """
+
+    from apscheduler.events import EVENT_JOB_SUBMITTED
+
+    def observe(event: JobSubmissionEvent) -> None:
+        for scheduled in event.scheduled_run_times:
+            JOB_LAG_SECONDS.observe((datetime.now(scheduled.tzinfo) - scheduled).total_seconds())
+
+    job_queue.scheduler.add_listener(observe, EVENT_JOB_SUBMITTED)
+
+
+def render() -> str:
+    return "".join(metric.render() for metric in _metrics)
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    from aiohttp import web
+
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    name: str
+    documentation: str
+    labels: tuple[str, ...]
+    type: str
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        _metrics.append(self)
+
+    def render(self) -> str:
+        header = f"# HELP {self.name} {self.documentation}\n# TYPE {self.name} {self.type}\n"
+        return header + "".join(f"{line}\n" for line in self._samples())
+
+    def _samples(self) -> Iterator[str]:
+        raise NotImplementedError()
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    _values: dict[tuple[str, ...], float]
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values = dict()
+
+    def inc(self, *label_values: str, amount: float = 1) -> None:
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _samples(self) -> Iterator[str]:
+        for label_values, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labels, label_values)} {value}"
+
+
+class Gauge(_Metric):
+    """ Value read from `function` whenever the metrics are collected """
+
+    type = "gauge"
+
+    _function: Callable[[], float]
+
+    def __init__(self, name: str, documentation: str, function: Callable[[], float]):
+        super().__init__(name, documentation)
+        self._function = function
+
+    def _samples(self) -> Iterator[str]:
+        yield f"{self.name} {self._function()}"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    _buckets: tuple[float, ...]
+    _values: dict[tuple[str, ...], tuple[list[int], list[float]]]
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labels: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        super().__init__(name, documentation, labels)
+        self._buckets = buckets
+        self._values = dict()
+
+    def observe(self, value: float, *label_values: str) -> None:
+        if label_values not in self._values:
+            self._values[label_values] = ([0] * (len(self._buckets) + 1), [0.0])
+        counts, total = self._values[label_values]
+        counts[bisect.bisect_left(self._buckets, value)] += 1
+        total[0] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def _samples(self) -> Iterator[str]:
+        for label_values, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self._buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                labels = _format_labels(self.labels, label_values, f'le="{le}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, label_values)} {total[0]}"
+            yield f"{self.name}_count{_format_labels(self.labels, label_values)} {cumulative}"
+
+
+JOB_LAG_SECONDS = Histogram("unciv_job_lag_seconds", "Delay between the scheduled and the actual start of a job")
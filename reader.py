@@ -2,30 +2,1054 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import codecs
+import concurrent.futures
 import contextlib
+import functools
 import gzip
+import hashlib
 import json
 import re
-from typing import Any, Iterator
+import time
+import zlib
+from collections import OrderedDict
+from logging import getLogger
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable, Iterable, Iterator
+from urllib.parse import urlsplit
 
-import aiohttp
+if TYPE_CHECKING:
+    # Imported on the first request, it takes longer to import than the rest of the bot until then
+    import aiohttp
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+from datatypes import get_config
+from metrics import Counter, Gauge, Histogram, SIZE_BUCKETS
+
+_logger = getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+
+# Payload formats told apart by their first bytes
+_PLAIN = "plain"
+_GZIP = "gzip"
+_BASE64_GZIP = "base64-gzip"
+_UNKNOWN = "unknown"
+
+# Seconds a long poll may take over the requested wait before it is given up
+_LONG_POLL_GRACE = 30
+
+# How servers can be asked whether a game file changed without downloading it
+_PROBE_HEAD = "head"
+_PROBE_RANGE = "range"
+_PROBE_NONE = "none"
+# Bytes at the end of a gzip payload compared by a range probe, they cover the CRC32 and size of the content
+_PROBE_TAIL = 32
+
+_session: aiohttp.ClientSession | None = None
+# (server, game_id) -> cached file, least recently used first
+_cache: OrderedDict[tuple[str, str], _CachedGamefile] = OrderedDict()
+_cache_size = 0
+_fetches: dict[tuple[str, str], asyncio.Future[_CachedGamefile]] = dict()
+# (server, game_id) -> when the members parsed for cached reads are dropped, soonest first
+_transient_expiry: OrderedDict[tuple[str, str], float] = OrderedDict()
+_game_source: GameSource | None = None
+# host -> _PROBE_HEAD, _PROBE_RANGE or _PROBE_NONE
+_probe_modes: dict[str, str] = dict()
+# Hosts answering HEAD requests with 405 or 501
+_head_unsupported: set[str] = set()
+# Hosts sending validators but answering conditional requests with the unchanged file instead of 304
+_conditional_ignored: set[str] = set()
+_executor: concurrent.futures.Executor | None = None
+_decode_slots: asyncio.Semaphore | None = None
+_host_limiters: dict[str, _HostLimiter] = dict()
+_server_health: dict[str, _ServerHealth] = dict()
+
+_FETCH_SECONDS = Histogram("unciv_fetch_seconds", "Duration of game file downloads", ("server", "status"))
+_PAYLOAD_BYTES = Histogram("unciv_payload_bytes", "Size of downloaded game files", ("server",), SIZE_BUCKETS)
+_DECODE_SECONDS = Histogram("unciv_decode_seconds", "Duration of game file decoding in the worker pool")
+_GAMEFILE_REQUESTS = Counter("unciv_gamefile_requests_total", "Game file requests by how they were served", ("result",))
+_PROBES = Counter("unciv_probes_total", "Probes whether a game file changed", ("server", "mode", "result"))
+_REJECTED_REQUESTS = Counter(
+    "unciv_rejected_requests_total", "Requests not sent because their server is unavailable", ("server",)
+)
+Gauge("unciv_gamefile_cache_bytes", "Size of cached game files", lambda: _cache_size)
+Gauge(
+    "unciv_unavailable_servers", "Servers requests are not sent to",
+    lambda: sum(health.unavailable for health in _server_health.values())
+)
+
+
+class ServerUnavailableError(Exception):
+    """ The server could not be reached, failed to answer, or is not asked at all after failing repeatedly """
+
+
+class GamefileError(Exception):
+    """ The server answered the game file request with an error status, e.g. 404 for an unknown game """
+
+    status: int
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+async def open_session() -> aiohttp.ClientSession:
+    """ Return the application-wide HTTP session, creating it on first use """
+
+    global _session
+
+    if _session is None or _session.closed:
+        import aiohttp
+
+        config = get_config()
+        connector = aiohttp.TCPConnector(
+            limit=config.HTTP_LIMIT,
+            limit_per_host=config.HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=config.HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=config.HTTP_KEEPALIVE_TIMEOUT,
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None, sock_connect=config.HTTP_CONNECT_TIMEOUT, sock_read=config.HTTP_READ_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _session
+
+
+async def close_session() -> None:
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def shutdown_decoder() -> None:
+    global _executor, _decode_slots
+
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    _decode_slots = None
+
+
+def available_json_backends() -> dict[str, Callable[[bytes | str], Any]]:
+    """ Return the `loads` functions of the installed JSON libraries, in the order of preference """
+
+    backends = dict()
+    if orjson is not None:
+        backends["orjson"] = orjson.loads
+    if msgspec is not None:
+        backends["msgspec"] = msgspec.json.decode
+    backends["json"] = json.loads
+    return backends
+
+
+def get_decode_stats() -> dict[str, float]:
+    """ Return the count, total and maximum of game file decode durations in seconds """
+
+    return _decode_stats.as_dict()
 
 
 @contextlib.asynccontextmanager
-async def gamefile(server: str, game_id: str) -> Iterator[_Gamefile]:
-    url = f"{server}/files/{game_id}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as response:
-            payload = await response.read()
-            decoded = base64.b64decode(payload)
+async def gamefile(
+        server: str,
+        game_id: str,
+        keys: Iterable[str] | None = None,
+        max_age: float | None = None
+) -> Iterator[_Gamefile]:
+    """
+    Download and parse the game file. When top-level `keys` are given, only these members of the save are parsed
+    and the rest of the file is skipped without being materialized.
+
+    A file downloaded less than `max_age` seconds ago (GAMEFILE_CACHE_TTL by default) is served from the cache and
+    concurrent callers share a single download. The members parsed for reads with the default `max_age` are dropped
+    from the cache after GAMEFILE_CACHE_TTL, only those of polls passing their own `max_age` are kept with the file.
+
+    Raises ServerUnavailableError when the download fails for a reason of the server or the network.
+    """
+
+    key = (server, game_id)
+    transient = max_age is None
+    max_age = get_config().GAMEFILE_CACHE_TTL if max_age is None else max_age
+
+    cached = _cache.get(key, None)
+    if cached and time.monotonic() - cached.fetched < max_age:
+        _GAMEFILE_REQUESTS.inc("fresh")
+        _cache.move_to_end(key)
+    else:
+        cached = await _fetch(server, game_id)
+
+    f = await cached.get_gamefile(keys, transient)
+    if transient:
+        _transient_expiry.pop(key, None)
+        _transient_expiry[key] = time.monotonic() + get_config().GAMEFILE_CACHE_TTL
+    _expire_transient()
+    yield f
+
+
+def get_game_source() -> GameSource:
+    """ Return the source of game file changes selected by GAME_SOURCE """
+
+    global _game_source
+
+    if _game_source is None:
+        _game_source = _GAME_SOURCES[get_config().GAME_SOURCE]()
+    return _game_source
+
+
+async def game_exists(server: str, game_id: str) -> bool:
+    """
+    Whether the server still has the game file, only a 404 response counts as a missing game. The server is asked
+    with a HEAD request, falling back to downloading the file when it does not support them. A missing game is
+    confirmed by a GET, some servers answer HEAD requests with 404 on routes only handling GET.
+    """
+
+    host = _get_host(server)
+    url = _get_url(server, game_id)
+    session = await open_session()
+    # Admitted only once a slot is free, the circuit may have opened while waiting for it
+    async with _get_host_limiter(server).slot():
+        with _get_server_health(server).request():
+            if host not in _head_unsupported:
+                async with session.head(url) as response:
+                    if response.status not in (404, 405, 501):
+                        _check_status(server, response)
+                        return True
+                if response.status != 404:
+                    _logger.info("Server %s does not support HEAD requests, checking games with GET", host)
+                    _head_unsupported.add(host)
+
+            async with session.get(url) as response:
+                _check_status(server, response)
+                return response.status != 404
+
+
+def forget(server: str, game_id: str) -> None:
+    """ Drop the cached copy of the game file, e.g. when nobody polls the game anymore """
+
+    global _cache_size
+
+    _transient_expiry.pop((server, game_id), None)
+    cached = _cache.pop((server, game_id), None)
+    if cached is not None:
+        _cache_size -= len(cached.payload)
+
+
+async def _fetch(server: str, game_id: str) -> _CachedGamefile:
+    """ Download the game file, joining the download already in progress for the same game if there is one """
+
+    key = (server, game_id)
+    fetch = _fetches.get(key, None)
+    if fetch is None:
+        fetch = asyncio.ensure_future(_download(server, game_id))
+        _fetches[key] = fetch
+        fetch.add_done_callback(lambda _: _fetches.pop(key, None))
+    else:
+        _GAMEFILE_REQUESTS.inc("joined")
+
+    # One caller giving up must not cancel the download for the others
+    return await asyncio.shield(fetch)
+
+
+async def _download(server: str, game_id: str, wait: float | None = None) -> _CachedGamefile:
+    """
+    Download the game file, conditionally when a copy is cached. With `wait`, the server is asked to hold the
+    request up to that many seconds until the file changes, such requests do not count against the host limiter.
+    """
+
+    key = (server, game_id)
+    cached = _cache.get(key, None)
+
+    headers = dict()
+    if cached and cached.etag:
+        headers["If-None-Match"] = cached.etag
+    if cached and cached.last_modified:
+        headers["If-Modified-Since"] = cached.last_modified
+
+    # Without an explicit timeout the timeouts of the session apply, passing None would disable them all
+    options = dict()
+    if wait is not None:
+        headers["Prefer"] = f"wait={int(wait)}"
+        from aiohttp import ClientTimeout
+
+        options["timeout"] = ClientTimeout(
+            total=wait + _LONG_POLL_GRACE, sock_connect=get_config().HTTP_CONNECT_TIMEOUT
+        )
+
+    host = _get_host(server)
+    session = await open_session()
+    # Admitted only once a slot is free, the circuit may have opened while waiting for it
+    async with _get_host_limiter(server).slot() if wait is None else contextlib.nullcontext():
+        with _get_server_health(server).request():
+            # A conditional download of an unchanged file is a single request answered without a body already
+            conditional = bool(cached and (cached.etag or cached.last_modified)) and host not in _conditional_ignored
+            if cached and not conditional and wait is None and get_config().PROBE_BEFORE_DOWNLOAD:
+                if await _probe_unchanged(session, server, game_id, cached):
+                    _GAMEFILE_REQUESTS.inc("probed")
+                    cached.refresh(cached.etag, cached.last_modified)
+                    _store(key, cached)
+                    return cached
+
+            started = time.perf_counter()
+            status = "error"
             try:
-                decompressed = gzip.decompress(decoded)
-                text = decompressed.decode("utf8")
-            except Exception:
-                text = payload.decode("utf8")
+                async with session.get(_get_url(server, game_id), headers=headers, **options) as response:
+                    status = str(response.status)
+                    _check_status(server, response)
+                    not_modified = response.status == 304
+                    payload = await response.read() if response.status == 200 else b""
+                    etag = response.headers.get("ETag", None)
+                    last_modified = response.headers.get("Last-Modified", None)
+            finally:
+                if wait is None:
+                    _FETCH_SECONDS.observe(time.perf_counter() - started, host, status)
+
+    if cached and not_modified:
+        _GAMEFILE_REQUESTS.inc("not_modified")
+        cached.refresh(cached.etag, cached.last_modified)
+        _store(key, cached)
+        return cached
+
+    # Error pages must not replace the cached file, nor be decoded as one
+    if status != "200":
+        _GAMEFILE_REQUESTS.inc("failed")
+        raise GamefileError(f"Server {host} answered game {game_id} with status {status}", int(status))
+
+    _PAYLOAD_BYTES.observe(len(payload), host)
+
+    digest = hashlib.blake2b(payload, digest_size=16).digest()
+    if cached and cached.digest == digest:
+        _GAMEFILE_REQUESTS.inc("unchanged")
+        if conditional:
+            _logger.info("Server %s ignores conditional requests, probing game files before downloading them", host)
+            _conditional_ignored.add(host)
+        cached.refresh(etag, last_modified)
+        _store(key, cached)
+        return cached
+
+    _GAMEFILE_REQUESTS.inc("downloaded")
+    cached = _CachedGamefile(payload, digest, etag, last_modified)
+    _store(key, cached)
+    return cached
+
+
+async def _probe_unchanged(
+        session: aiohttp.ClientSession,
+        server: str,
+        game_id: str,
+        cached: _CachedGamefile
+) -> bool:
+    """
+    Ask the server whether the cached game file is still current without downloading it, using a HEAD request for
+    the validators and the size or a ranged request for the end of the gzip payload. What the server supports is
+    detected on the first probe and remembered, servers supporting neither are not probed anymore.
+    """
+
+    from aiohttp import ClientError
+
+    host = _get_host(server)
+    url = _get_url(server, game_id)
+    mode = _probe_modes.get(host, None)
+    if mode == _PROBE_NONE:
+        return False
+
+    try:
+        if mode in (None, _PROBE_HEAD):
+            async with session.head(url) as response:
+                etag = response.headers.get("ETag", None)
+                last_modified = response.headers.get("Last-Modified", None)
+                # The length of an encoded body differs from the cached payload decoded by aiohttp
+                length = None if "Content-Encoding" in response.headers else response.content_length
+            # Only validators the full download sends as well can be compared
+            supported = (etag and cached.etag) or (last_modified and cached.last_modified)
+            if response.status == 200 and supported:
+                _set_probe_mode(host, _PROBE_HEAD)
+                unchanged = (etag, last_modified) == (cached.etag, cached.last_modified)
+                # A different size is a change even when a weak validator did not catch it
+                unchanged = unchanged and length in (None, len(cached.payload))
+                _PROBES.inc(host, _PROBE_HEAD, "unchanged" if unchanged else "changed")
+                return unchanged
+            if not _is_unsupported(response.status):
+                # A failing server tells nothing about what it supports, the next probe detects it again
+                _PROBES.inc(host, mode or "detect", "error")
+                return False
+            if mode == _PROBE_HEAD:
+                return False
+
+        if _sniff(cached.payload) not in (_GZIP, _BASE64_GZIP):
+            # The end of a plain JSON file tells nothing about its content
+            return False
+
+        async with session.get(url, headers={"Range": f"bytes=-{_PROBE_TAIL}"}) as response:
+            content_range = response.headers.get("Content-Range", "")
+            tail = await response.read() if response.status == 206 else None
+        if tail is None:
+            if _is_unsupported(response.status):
+                _set_probe_mode(host, _PROBE_NONE)
+            else:
+                _PROBES.inc(host, mode or "detect", "error")
+            return False
+
+        _set_probe_mode(host, _PROBE_RANGE)
+        unchanged = content_range.endswith(f"/{len(cached.payload)}") and cached.payload.endswith(tail)
+        _PROBES.inc(host, _PROBE_RANGE, "unchanged" if unchanged else "changed")
+        return unchanged
+    except (ClientError, asyncio.TimeoutError):
+        _logger.debug("Probing game file failed server=%s, gameid=%s", server, game_id, exc_info=True)
+        _PROBES.inc(host, mode or "detect", "error")
+        return False
+
+
+def _is_unsupported(status: int) -> bool:
+    """ Whether a probe answer means the request is not supported, a 200 lacks the validators or ignores the Range """
+
+    return status in (200, 405, 501)
+
+
+def _set_probe_mode(host: str, mode: str) -> None:
+    if _probe_modes.get(host, None) != mode:
+        _logger.info("Probing game files on %s with %s requests", host, mode)
+        _probe_modes[host] = mode
+
+
+def _expire_transient() -> None:
+    """ Drop the members parsed for cached reads longer than GAMEFILE_CACHE_TTL ago, their size is not limited """
+
+    now = time.monotonic()
+    while _transient_expiry and next(iter(_transient_expiry.values())) <= now:
+        key, _ = _transient_expiry.popitem(last=False)
+        cached = _cache.get(key, None)
+        if cached is not None:
+            cached.drop_transient()
+
+
+def _store(key: tuple[str, str], cached: _CachedGamefile) -> None:
+    """ Put the file to the cache as the most recently used one, evicting the least recently used over the limit """
+
+    global _cache_size
+
+    previous = _cache.pop(key, None)
+    if previous is not None:
+        _cache_size -= len(previous.payload)
+
+    _cache[key] = cached
+    _cache_size += len(cached.payload)
+
+    limit = get_config().GAMEFILE_CACHE_BYTES
+    while _cache_size > limit and len(_cache) > 1:
+        _, evicted = _cache.popitem(last=False)
+        _cache_size -= len(evicted.payload)
+
+
+def _get_url(server: str, game_id: str) -> str:
+    return f"{server}/files/{game_id}"
+
+
+def _get_host(server: str) -> str:
+    return urlsplit(server).netloc
+
+
+def _check_status(server: str, response: aiohttp.ClientResponse) -> None:
+    if response.status >= 500:
+        raise ServerUnavailableError(f"Server {_get_host(server)} answered with status {response.status}")
+
+
+def _get_server_health(server: str) -> _ServerHealth:
+    host = _get_host(server)
+    if host not in _server_health:
+        config = get_config()
+        _server_health[host] = _ServerHealth(
+            host, config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_OPEN_SECONDS, config.CIRCUIT_MAX_OPEN_SECONDS
+        )
+    return _server_health[host]
+
+
+def _get_host_limiter(server: str) -> _HostLimiter:
+    host = _get_host(server)
+    if host not in _host_limiters:
+        config = get_config()
+        _host_limiters[host] = _HostLimiter(config.FETCH_CONCURRENCY_PER_HOST, config.FETCH_SLOW_SECONDS)
+    return _host_limiters[host]
+
+
+async def _decode_in_executor(payload: bytes, keys: frozenset[str] | None) -> Any:
+    """ Decode the payload in the worker pool, waiting for a free slot when too many decodes are pending """
+
+    global _executor, _decode_slots
+
+    config = get_config()
+    if _executor is None:
+        if config.DECODE_EXECUTOR == "process":
+            _executor = concurrent.futures.ProcessPoolExecutor(max_workers=config.DECODE_WORKERS)
+        else:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=config.DECODE_WORKERS, thread_name_prefix="decoder"
+            )
+    if _decode_slots is None:
+        _decode_slots = asyncio.Semaphore(config.DECODE_WORKERS + config.DECODE_QUEUE_SIZE)
+
+    async with _decode_slots:
+        started = time.perf_counter()
+        data = await asyncio.get_running_loop().run_in_executor(_executor, _decode, payload, keys)
+        duration = time.perf_counter() - started
+
+    _decode_stats.observe(duration)
+    _DECODE_SECONDS.observe(duration)
+    _logger.debug("Decoded %s bytes in %.3f s", len(payload), duration)
+    return data
+
+
+def _decode(
+        payload: bytes,
+        keys: frozenset[str] | None = None,
+        backend: str | None = None,
+        streaming: bool | None = None
+) -> Any:
+    config = get_config()
+    backend = backend or config.JSON_BACKEND
+    if backend == "auto" and keys is not None and msgspec is not None:
+        # orjson is the fastest at decoding whole files, but msgspec skips the members not asked for
+        backend = "msgspec"
+    backend, loads = _get_json_backend(backend)
+
+    if keys is not None and backend == "msgspec":
+        # msgspec skips the members missing in the target struct without materializing them
+        decoded = msgspec.json.decode(_decompress(payload), type=_get_toplevel_struct(keys))
+        return {key: value for key in keys if (value := getattr(decoded, key)) is not msgspec.UNSET}
+
+    # The scanner never holds the whole text, but costs about twice the CPU time of a full decode
+    if keys is not None and (config.STREAMING_DECODE if streaming is None else streaming):
+        return _TopLevelScanner(_iter_text(payload), loads).scan(keys)
+
+    data = loads(_decompress(payload))
+    if keys is not None:
+        return {key: data[key] for key in keys if key in data}
+    return data
+
+
+@functools.cache
+def _get_json_backend(name: str) -> tuple[str, Callable[[bytes | str], Any]]:
+    backends = available_json_backends()
+    if name == "auto":
+        name = next(iter(backends))
+    if name not in backends:
+        raise ValueError(f"JSON backend {name} is not installed")
+
+    _logger.debug("Decoding game files with %s", name)
+    return name, backends[name]
+
+
+@functools.cache
+def _get_toplevel_struct(keys: frozenset[str]) -> type:
+    return msgspec.defstruct("TopLevel", [(key, Any, msgspec.UNSET) for key in sorted(keys)])
+
+
+def _sniff(payload: bytes) -> str:
+    start = payload[:16].lstrip()
+    if start.startswith((b"{", b"[")):
+        return _PLAIN
+    if start.startswith(b"\x1f\x8b"):
+        return _GZIP
+    # Base64 of the gzip magic and the deflate method byte
+    if start.startswith(b"H4sI"):
+        return _BASE64_GZIP
+    return _UNKNOWN
+
+
+def _decompress(payload: bytes) -> bytes:
+    """ Return the JSON text of the payload """
+
+    payload_format = _sniff(payload)
+    if payload_format == _PLAIN:
+        return payload
+    if payload_format == _GZIP:
+        return gzip.decompress(payload)
+    if payload_format == _BASE64_GZIP:
+        return gzip.decompress(base64.b64decode(payload))
+
+    try:
+        return gzip.decompress(base64.b64decode(payload))
+    except Exception:
+        return payload
+
+
+def _iter_text(payload: bytes) -> Iterator[str]:
+    """ Yield the decoded text of the payload chunk by chunk """
+
+    payload_format = _sniff(payload)
+    if payload_format == _PLAIN:
+        return _iter_plain(payload)
+    if payload_format == _GZIP:
+        return _iter_gzip(_iter_blocks(payload))
+    if payload_format == _BASE64_GZIP:
+        return _iter_gzip(_iter_base64(payload))
+    return _iter_any(payload)
+
+
+def _iter_any(payload: bytes) -> Iterator[str]:
+    """ Try base64-encoded gzip first, falling back to plain text payloads """
+
+    chunks = _iter_gzip(_iter_base64(payload))
+    try:
+        first = next(chunks)
+    except (ValueError, zlib.error):
+        chunks = _iter_plain(payload)
+        first = next(chunks)
+
+    yield first
+    yield from chunks
+
+
+def _iter_blocks(payload: bytes) -> Iterator[bytes]:
+    for start in range(0, len(payload), _CHUNK_SIZE):
+        yield payload[start:start + _CHUNK_SIZE]
+
+
+def _iter_base64(payload: bytes) -> Iterator[bytes]:
+    for block in _iter_blocks(payload.translate(None, b" \t\r\n")):
+        yield base64.b64decode(block)
+
+
+def _iter_gzip(blocks: Iterator[bytes]) -> Iterator[str]:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    decoder = codecs.getincrementaldecoder("utf8")()
+
+    for data in blocks:
+        while data:
+            yield decoder.decode(decompressor.decompress(data, _CHUNK_SIZE))
+            data = decompressor.unconsumed_tail
+
+    yield decoder.decode(decompressor.flush(), final=True)
+
+
+def _iter_plain(payload: bytes) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder("utf8")()
+
+    for start in range(0, len(payload), _CHUNK_SIZE):
+        yield decoder.decode(payload[start:start + _CHUNK_SIZE])
+
+    yield decoder.decode(b"", final=True)
+
+
+class _TopLevelScanner:
+    """
+    Extracts selected members of a top-level JSON object from a stream of text chunks. Skipped values are only
+    scanned for their end, consumed text is released as the scan goes and the stream is abandoned as soon as all
+    requested members are found.
+    """
+
+    _WHITESPACE = re.compile(r"[ \t\n\r]*")
+    _STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*("?)')
+    _SCALAR = re.compile(r"[^,}\]\s]*")
+    _STRUCTURE = re.compile(r'(?:[^"\[\]{}]+|"[^"\\]*(?:\\.[^"\\]*)*")*')
+
+    _chunks: Iterator[str]
+    _loads: Callable[[str], Any]
+    _buffer: str
+    _pos: int
+
+    def __init__(self, chunks: Iterator[str], loads: Callable[[str], Any] = json.loads):
+        self._chunks = chunks
+        self._loads = loads
+        self._buffer = ""
+        self._pos = 0
+
+    def scan(self, keys: Iterable[str]) -> dict[str, Any]:
+        wanted = set(keys)
+        found = dict()
+
+        self._expect("{")
+        if self._peek() == "}":
+            return found
+
+        while wanted:
+            self._discard()
+            key = self._read_key()
+            self._expect(":")
+            self._skip_whitespace()
+
+            if key in wanted:
+                end = self._find_value_end(keep=True)
+                found[key] = self._loads(self._buffer[self._pos:end])
+                wanted.discard(key)
+            else:
+                end = self._find_value_end(keep=False)
+            self._pos = end
+
+            separator = self._peek()
+            self._pos += 1
+            if separator == "}":
+                break
+            if separator != ",":
+                raise ValueError(f"Expected ',' or '}}' in game file, got {separator!r}")
+
+        return found
+
+    def _fill(self) -> None:
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            raise ValueError("Unexpected end of game file")
+        self._buffer += chunk
+
+    def _discard(self) -> None:
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+
+    def _skip_whitespace(self) -> None:
+        while True:
+            self._pos = self._WHITESPACE.match(self._buffer, self._pos).end()
+            if self._pos < len(self._buffer):
+                return
+            self._discard()
+            self._fill()
+
+    def _peek(self) -> str:
+        self._skip_whitespace()
+        return self._buffer[self._pos]
+
+    def _expect(self, char: str) -> None:
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} in game file, got {found!r}")
+        self._pos += 1
+
+    def _read_key(self) -> str:
+        self._skip_whitespace()
+        end = self._find_value_end(keep=True)
+        key = json.loads(self._buffer[self._pos:end])
+        self._pos = end
+        return key
+
+    def _find_value_end(self, keep: bool) -> int:
+        """ Return the buffer index just past the value starting at the current position """
+
+        first = self._buffer[self._pos]
+
+        if first == '"':
+            while not (match := self._STRING.match(self._buffer, self._pos)).group(1):
+                self._fill()
+            return match.end()
+
+        if first not in "[{":
+            while (end := self._SCALAR.match(self._buffer, self._pos).end()) == len(self._buffer):
+                self._fill()
+            return end
+
+        depth = 0
+        scan = self._pos
+        while True:
+            scan = self._STRUCTURE.match(self._buffer, scan).end()
+            if scan == len(self._buffer) or self._buffer[scan] == '"':
+                # Out of data, possibly in the middle of a string, continue with the next chunk
+                if not keep:
+                    self._pos = scan
+                    self._discard()
+                    scan = 0
+                self._fill()
+                continue
+
+            depth += 1 if self._buffer[scan] in "[{" else -1
+            scan += 1
+            if depth == 0:
+                return scan
+
+
+class GameSource:
+    """
+    Tells when a game file changed, so it does not have to be downloaded on every poll. The file itself is always
+    read through `gamefile`.
+    """
+
+    async def wait_for_change(self, server: str, game_id: str, timeout: float) -> bool | None:
+        """
+        Wait up to `timeout` seconds for the game file to change. Return whether it changed, or None when the source
+        cannot watch the file and it has to be polled on a timer.
+        """
+
+        raise NotImplementedError()
+
+
+class _PollingSource(GameSource):
+    """ Plain HTTP polling, there is no change signal """
+
+    async def wait_for_change(self, server: str, game_id: str, timeout: float) -> bool | None:
+        return None
+
+
+class _LongPollSource(GameSource):
+    """
+    Conditional GET asking the server to hold the request until the file changes (`Prefer: wait`, RFC 7240). A server
+    that answers without a change before half of the wait, or sends no validators, does not support it and its games
+    are polled on a timer from then on. The changed file is put to the cache.
+    """
+
+    _unsupported: set[str]
+    _slots: dict[str, asyncio.Semaphore]
+
+    def __init__(self):
+        self._unsupported = set()
+        self._slots = dict()
+
+    async def wait_for_change(self, server: str, game_id: str, timeout: float) -> bool | None:
+        host = _get_host(server)
+        if host in self._unsupported:
+            return None
+
+        cached = _cache.get((server, game_id), None)
+        if cached is None:
+            await _fetch(server, game_id)
+            return True
+
+        if not cached.etag and not cached.last_modified:
+            self._set_unsupported(host, "it sends no ETag nor Last-Modified")
+            return None
+
+        if host not in self._slots:
+            self._slots[host] = asyncio.Semaphore(get_config().LONG_POLL_CONCURRENCY_PER_HOST)
+
+        async with self._slots[host]:
+            started = time.monotonic()
+            updated = await _download(server, game_id, wait=timeout)
+
+        if updated is not cached:
+            return True
+        if time.monotonic() - started < timeout / 2:
+            self._set_unsupported(host, "it answers without waiting for a change")
+            return None
+        return False
+
+    def _set_unsupported(self, host: str, reason: str) -> None:
+        _logger.info("Server %s does not support long polling, %s, polling it on a timer", host, reason)
+        self._unsupported.add(host)
+
+
+_GAME_SOURCES: dict[str, type[GameSource]] = {
+    "poll": _PollingSource,
+    "long-poll": _LongPollSource,
+}
+
+
+class _HostLimiter:
+    """
+    Caps the number of concurrent requests to a single server. The cap is halved whenever a request fails or takes
+    longer than `slow_seconds` and grows back by one with every fast response, so pollers back off while the server
+    struggles.
+    """
+
+    _max_limit: int
+    _limit: int
+    _in_flight: int
+    _slow_seconds: float
+    _condition: asyncio.Condition
+
+    def __init__(self, limit: int, slow_seconds: float):
+        self._max_limit = limit
+        self._limit = limit
+        self._in_flight = 0
+        self._slow_seconds = slow_seconds
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self._limit)
+            self._in_flight += 1
+
+        started = time.perf_counter()
+        healthy = False
+        try:
+            yield
+            healthy = time.perf_counter() - started <= self._slow_seconds
+        finally:
+            async with self._condition:
+                self._in_flight -= 1
+                if healthy:
+                    self._limit = min(self._max_limit, self._limit + 1)
+                elif self._limit > 1:
+                    self._limit //= 2
+                    _logger.info("Server responds slowly, limiting concurrent requests to %s", self._limit)
+                self._condition.notify_all()
+
+
+class _ServerHealth:
+    """
+    Circuit breaker of a single server. After `threshold` consecutive failed requests no requests are sent to the
+    server for `open_seconds`, then a single request is let through to probe it. Every failed probe doubles the pause
+    up to `max_open_seconds`, the first successful request closes the circuit again. Outages are logged once when
+    the circuit opens and once when it closes, not for every rejected request.
+    """
+
+    _host: str
+    _threshold: int
+    _open_seconds: float
+    _max_open_seconds: float
+    _failures: int
+    _delay: float
+    _open_until: float | None
+    _probing: bool
+    _rejected: int
+
+    def __init__(self, host: str, threshold: int, open_seconds: float, max_open_seconds: float):
+        self._host = host
+        self._threshold = threshold
+        self._open_seconds = open_seconds
+        self._max_open_seconds = max_open_seconds
+        self._failures = 0
+        self._delay = open_seconds
+        self._open_until = None
+        self._probing = False
+        self._rejected = 0
+
+    @property
+    def unavailable(self) -> bool:
+        return self._open_until is not None
+
+    @contextlib.contextmanager
+    def request(self) -> Iterator[None]:
+        """
+        Track the outcome of a request to the server. Network errors and timeouts are raised as
+        ServerUnavailableError, which is raised right away without a request while the circuit is open.
+        """
+
+        from aiohttp import ClientError
+
+        probe = self._admit()
+        try:
+            yield
+        except ServerUnavailableError as err:
+            self._failed(str(err), probe)
+            raise
+        except (ClientError, asyncio.TimeoutError) as err:
+            reason = f"{type(err).__name__}: {err}"
+            self._failed(reason, probe)
+            raise ServerUnavailableError(f"Request to {self._host} failed, {reason}") from err
+        else:
+            self._succeeded()
+        finally:
+            if probe:
+                self._probing = False
+
+    def _admit(self) -> bool:
+        """ Return whether the request probes an open circuit, raise when it must not be sent """
+
+        if self._open_until is None:
+            return False
+
+        remaining = self._open_until - time.monotonic()
+        if self._probing or remaining > 0:
+            self._rejected += 1
+            _REJECTED_REQUESTS.inc(self._host)
+            raise ServerUnavailableError(f"Server {self._host} is unavailable, next try in {max(remaining, 0):.0f} s")
+
+        self._probing = True
+        return True
+
+    def _failed(self, reason: str, probe: bool) -> None:
+        self._failures += 1
+
+        if probe:
+            self._delay = min(self._delay * 2, self._max_open_seconds)
+            self._open_until = time.monotonic() + self._delay
+            _logger.debug("Server %s is still unavailable, next try in %s s: %s", self._host, self._delay, reason)
+        elif self._open_until is None and self._failures >= self._threshold:
+            self._delay = self._open_seconds
+            self._open_until = time.monotonic() + self._delay
+            _logger.error(
+                "Server %s is unavailable after %s failed requests, pausing requests for %s s. Last error: %s",
+                self._host, self._failures, self._delay, reason
+            )
+
+    def _succeeded(self) -> None:
+        if self._open_until is not None:
+            _logger.warning(
+                "Server %s is available again, %s requests were skipped during the outage", self._host, self._rejected
+            )
+
+        self._failures = 0
+        self._open_until = None
+        self._rejected = 0
+
+
+class _Timings:
+    count: int
+    total: float
+    maximum: float
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, duration: float) -> None:
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+
+    def as_dict(self) -> dict[str, float]:
+        return {"count": self.count, "total": self.total, "max": self.maximum}
+
+
+_decode_stats = _Timings()
+
+
+class _CachedGamefile:
+    """ Downloaded game file with its validators and the files parsed from it so far, by their top-level keys """
+
+    payload: bytes
+    digest: bytes
+    etag: str | None
+    last_modified: str | None
+    fetched: float
+    _parsed: dict[frozenset[str] | None, _Gamefile]
+    _transient: set[frozenset[str] | None]
+
+    def __init__(self, payload: bytes, digest: bytes, etag: str | None, last_modified: str | None):
+        self.payload = payload
+        self.digest = digest
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+        self._parsed = dict()
+        self._transient = set()
+
+    def refresh(self, etag: str | None, last_modified: str | None) -> None:
+        """ Mark the file as just downloaded, the content did not change """
+
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = time.monotonic()
+
+    async def get_gamefile(self, keys: Iterable[str] | None, transient: bool = False) -> _Gamefile:
+        """
+        Return the file parsed with (at least) the requested top-level keys, parsing the payload if needed. A
+        `transient` parse is kept until `drop_transient` is called.
+        """
+
+        keys = frozenset(keys) if keys is not None else None
+        for parsed_keys, f in self._parsed.items():
+            if parsed_keys is None or (keys is not None and keys <= parsed_keys):
+                return f
+
+        f = _Gamefile(await _decode_in_executor(self.payload, keys))
+        self._parsed[keys] = f
+        if transient:
+            self._transient.add(keys)
+        return f
 
-    json_data = json.loads(text)
-    yield _Gamefile(json_data)
+    def drop_transient(self) -> None:
+        for keys in self._transient:
+            self._parsed.pop(keys, None)
+        self._transient.clear()
 
 
 class _Gamefile:
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import sqlite3
+import time
+from logging import getLogger
+from pathlib import Path
+from typing import Any
+
+from telegram.ext import BasePersistence, PersistenceInput, PicklePersistence
+
+from datatypes import Registration
+
+_logger = getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS games (
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (user_id, chat_id, name)
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+
+class SqlitePersistence(BasePersistence):
+    """
+    Stores user data and conversation states in an SQLite database. Every registration of `user_data["games"]` is
+    a row of its own and only rows whose content changed since the last write are touched, so a persistence run
+    costs the same no matter how many registrations are stored. All writes of a run are committed together.
+
+    On first start the content of the pickle file written by the former PicklePersistence is imported.
+    """
+
+    filepath: Path
+    legacy_filepath: Path | None
+
+    _connection: sqlite3.Connection | None
+    _users: dict[int, str]
+    # user_id -> {(chat_id, name): data}, names are unique per chat and a user may register in several chats
+    _games: dict[int, dict[tuple[int, str], str]]
+    _commit_scheduled: bool
+
+    def __init__(self, filepath: str | Path, legacy_filepath: str | Path | None = None, update_interval: float = 60):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.filepath = Path(filepath)
+        self.legacy_filepath = Path(legacy_filepath) if legacy_filepath is not None else None
+        self._connection = None
+        self._users = dict()
+        self._games = dict()
+        self._commit_scheduled = False
+
+    async def get_user_data(self) -> dict[int, dict[str, Any]]:
+        connection = await self._open()
+
+        user_data = dict()
+        for user_id, data in connection.execute("SELECT user_id, data FROM users"):
+            self._users[user_id] = data
+            user_data[user_id] = json.loads(data)
+
+        rows = connection.execute("SELECT user_id, chat_id, name, data FROM games ORDER BY rowid")
+        for user_id, chat_id, name, data in rows:
+            self._games.setdefault(user_id, dict())[(chat_id, name)] = data
+            registration = Registration.from_dict(json.loads(data))
+            user_data.setdefault(user_id, dict()).setdefault("games", list()).append(registration)
+
+        _logger.info("Loaded %s users from %s", len(user_data), self.filepath)
+        return user_data
+
+    async def get_chat_data(self) -> dict[int, Any]:
+        return dict()
+
+    async def get_bot_data(self) -> dict[Any, Any]:
+        return dict()
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict[tuple[int | str, ...], object]:
+        connection = await self._open()
+        rows = connection.execute("SELECT key, state FROM conversations WHERE name = ?", (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name: str, key: tuple[int | str, ...], new_state: object | None) -> None:
+        connection = await self._open()
+        self._write_conversation(connection, name, key, new_state)
+        self._schedule_commit()
+
+    async def update_user_data(self, user_id: int, data: dict[str, Any]) -> None:
+        connection = await self._open()
+        self._write_user_data(connection, user_id, data)
+        self._schedule_commit()
+
+    async def update_chat_data(self, chat_id: int, data: Any) -> None:
+        pass
+
+    async def update_bot_data(self, data: Any) -> None:
+        pass
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        connection = await self._open()
+        connection.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        connection.execute("DELETE FROM games WHERE user_id = ?", (user_id,))
+        self._users.pop(user_id, None)
+        self._games.pop(user_id, None)
+        self._schedule_commit()
+
+    async def refresh_user_data(self, user_id: int, user_data: dict[str, Any]) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._connection is not None:
+            self._commit()
+            self._connection.close()
+            self._connection = None
+
+    async def _open(self) -> sqlite3.Connection:
+        if self._connection is not None:
+            return self._connection
+
+        self.filepath.parent.mkdir(parents=True, exist_ok=True)
+        connection = sqlite3.connect(self.filepath)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(_SCHEMA)
+        self._connection = connection
+
+        migrated = connection.execute("SELECT value FROM meta WHERE key = 'migrated_from'").fetchone()
+        if not migrated and self.legacy_filepath is not None and self.legacy_filepath.exists():
+            await self._migrate(connection)
+
+        return connection
+
+    async def _migrate(self, connection: sqlite3.Connection) -> None:
+        """ Import user data and conversations from the pickle file of PicklePersistence """
+
+        _logger.info("Migrating %s to %s", self.legacy_filepath, self.filepath)
+
+        legacy = PicklePersistence(self.legacy_filepath, store_data=PersistenceInput(callback_data=False))
+        legacy.set_bot(self.bot)
+
+        user_data = await legacy.get_user_data()
+        for user_id, data in user_data.items():
+            data["games"] = [Registration.from_dict(game) for game in data.get("games", None) or ()]
+            self._write_user_data(connection, user_id, data)
+
+        for name, conversation in (legacy.conversations or dict()).items():
+            for key, state in conversation.items():
+                self._write_conversation(connection, name, key, state)
+
+        connection.execute("INSERT INTO meta (key, value) VALUES ('migrated_from', ?)", (str(self.legacy_filepath),))
+        connection.commit()
+
+        # Rows are read back by get_user_data, the write cache has to start empty
+        self._users.clear()
+        self._games.clear()
+        _logger.info("Migrated %s users", len(user_data))
+
+    def _write_user_data(self, connection: sqlite3.Connection, user_id: int, data: dict[str, Any]) -> None:
+        """ Write the rows of the user that differ from the last written state """
+
+        user = json.dumps({key: value for key, value in data.items() if key != "games"})
+        games = {game.key: json.dumps(game.as_dict()) for game in data.get("games", None) or ()}
+        stored_games = self._games.get(user_id, dict())
+
+        if self._users.get(user_id, None) != user:
+            connection.execute(
+                "INSERT INTO users (user_id, data) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET data = excluded.data",
+                (user_id, user)
+            )
+
+        connection.executemany(
+            "DELETE FROM games WHERE user_id = ? AND chat_id = ? AND name = ?",
+            [(user_id, chat_id, name) for chat_id, name in stored_games.keys() - games.keys()]
+        )
+        connection.executemany(
+            "INSERT INTO games (user_id, chat_id, name, data) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (user_id, chat_id, name) DO UPDATE SET data = excluded.data",
+            [(user_id, *key, game) for key, game in games.items() if stored_games.get(key, None) != game]
+        )
+
+        self._users[user_id] = user
+        self._games[user_id] = games
+
+    @staticmethod
+    def _write_conversation(
+            connection: sqlite3.Connection,
+            name: str,
+            key: tuple[int | str, ...],
+            state: object | None
+    ) -> None:
+        if state is None:
+            connection.execute("DELETE FROM conversations WHERE name = ? AND key = ?", (name, json.dumps(key)))
+        else:
+            connection.execute(
+                "INSERT INTO conversations (name, key, state) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, key) DO UPDATE SET state = excluded.state",
+                (name, json.dumps(key), json.dumps(state))
+            )
+
+    def _schedule_commit(self) -> None:
+        """ Commit once all updates of the current persistence run were written """
+
+        if not self._commit_scheduled:
+            self._commit_scheduled = True
+            asyncio.get_running_loop().call_soon(self._commit)
+
+    def _commit(self) -> None:
+        self._commit_scheduled = False
+        if self._connection is None or not self._connection.in_transaction:
+            return
+
+        started = time.perf_counter()
+        self._connection.commit()
+        _logger.debug("Committed storage in %.3f s", time.perf_counter() - started)
@@ -0,0 +1,53 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import data
+from datatypes import Registration
+
+
+def _registration(chatid: int, name: str, gameid: str) -> Registration:
+    return Registration(
+        name=name, server="https://uncivserver.xyz", gameid=gameid, nation="Rome", chatid=chatid, period=60
+    )
+
+
+def test_chat_registrations_index():
+    registrations = [_registration(1, "a", "1"), _registration(1, "b", "2"), _registration(-100, "a", "3")]
+    for registration in registrations:
+        data._subscribe(registration)
+
+    try:
+        assert data.list_chat_registrations(1) == registrations[:2]
+        assert data.list_chat_registrations(-100) == registrations[2:]
+        assert data.list_chat_registrations(2) == []
+
+        data.remove_notify_job(None, registrations[0])
+        assert data.list_chat_registrations(1) == registrations[1:2]
+
+        data.remove_notify_job(None, registrations[2])
+        assert -100 not in data._chat_registrations
+    finally:
+        for registration in registrations:
+            data.remove_notify_job(None, registration)
+
+
+def test_new_subscriber_resets_the_backed_off_interval():
+    first = _registration(1, "a", "1")
+    second = _registration(2, "b", "1")
+    job = SimpleNamespace(
+        name="poll", removed=False, job=mock.Mock(),
+        data={"server": first.server, "gameid": "1", "period": 60, "interval": 900, "state": ("Rome", 3)}
+    )
+    data._subscribe(first)
+    data._poll_jobs[first.game_key] = job
+
+    try:
+        data._subscribe(second)
+        assert data._schedule_poll_job(None, *second.game_key) == "poll"
+
+        assert "interval" not in job.data and "state" not in job.data
+        job.job.reschedule.assert_called_once_with(trigger="interval", seconds=60, jitter=mock.ANY)
+    finally:
+        data.remove_notify_job(None, second)
+        data._poll_jobs.pop(first.game_key, None)
+        data.remove_notify_job(None, first)
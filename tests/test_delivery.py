@@ -0,0 +1,30 @@
+import pytest
+from telegram.constants import MessageLimit
+
+from delivery import _Dispatcher
+
+
+@pytest.mark.parametrize(("chat_id", "delay"), [(1, 1), (-100, 3)])
+def test_group_chats_have_a_lower_rate(chat_id, delay):
+    dispatcher = _Dispatcher(None, 25, 1, 1 / 3, 8)
+
+    bucket = dispatcher._get_chat_bucket(chat_id)
+    bucket.take()
+
+    assert bucket.delay() == pytest.approx(delay, abs=0.01)
+
+
+def test_queued_texts_are_merged_up_to_the_message_limit():
+    dispatcher = _Dispatcher(None, 25, 1, 1 / 3, 8)
+    texts = ["a" * 1000] * 5 + ["b"]
+    for text in texts:
+        dispatcher._pending.setdefault(1, list()).append(text)
+    dispatcher._pending[2] = ["c"]
+
+    first = dispatcher._take_texts(1)
+    assert list(dispatcher._pending) == [2, 1]
+    second = dispatcher._take_texts(1)
+
+    assert first == texts[:4] and len("\n\n".join(first)) <= MessageLimit.MAX_TEXT_LENGTH
+    assert second == texts[4:]
+    assert list(dispatcher._pending) == [2]
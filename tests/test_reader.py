@@ -0,0 +1,479 @@
+import asyncio
+import base64
+import gzip
+import json
+import random
+import time
+from collections import OrderedDict
+
+import pytest
+from aiohttp import web
+
+import reader
+from datatypes import Config
+from reader import _TopLevelScanner, _decode, _iter_text, available_json_backends
+
+_TRICKY_STRINGS = [
+    "",
+    "plain",
+    'quote " inside',
+    "backslash \\ and \\\" escaped quote",
+    "brackets { } [ ] , : inside",
+    "ends with backslash \\",
+    "unicode Zürich 東京 \U0001f600",
+    "control \n\t\r characters",
+]
+
+
+def _random_value(rng: random.Random, depth: int = 0):
+    kind = rng.randrange(8 if depth < 3 else 5)
+    if kind == 0:
+        return rng.choice(_TRICKY_STRINGS)
+    if kind == 1:
+        return rng.randint(-10 ** 6, 10 ** 6)
+    if kind == 2:
+        return rng.uniform(-1e3, 1e3)
+    if kind == 3:
+        return rng.choice([True, False, None])
+    if kind == 4:
+        return "".join(rng.choice(_TRICKY_STRINGS) for _ in range(rng.randint(1, 4)))
+    if kind == 5:
+        return [_random_value(rng, depth + 1) for _ in range(rng.randint(0, 5))]
+    return {rng.choice(_TRICKY_STRINGS) + str(i): _random_value(rng, depth + 1) for i in range(rng.randint(0, 5))}
+
+
+def _random_document(rng: random.Random) -> dict:
+    document = {f"member{i}": _random_value(rng) for i in range(rng.randint(0, 8))}
+    # Keys looking like the requested ones must not be matched inside nested values or strings
+    document["nested"] = {"currentPlayer": "Nested", "turns": -1, "text": '"turns": 5'}
+    return document
+
+
+def _dumps(rng: random.Random, document: dict) -> str:
+    indent = rng.choice([None, 0, 2, "\t"])
+    separators = rng.choice([(",", ":"), (", ", ": "), (" ,\r\n", " :\t")]) if indent is None else None
+    return json.dumps(document, indent=indent, separators=separators, ensure_ascii=rng.random() < 0.5)
+
+
+def _split(rng: random.Random, text: str) -> list[str]:
+    chunks = list()
+    start = 0
+    while start < len(text):
+        end = start + rng.choice([1, 2, 3, 7, 64, 4096])
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_scanner_matches_loads(seed):
+    rng = random.Random(seed)
+    document = _random_document(rng)
+    keys = set(rng.sample(sorted(document), rng.randint(0, len(document)))) | {"missing"}
+    text = _dumps(rng, document)
+
+    found = _TopLevelScanner(iter(_split(rng, text))).scan(keys)
+
+    assert found == {key: document[key] for key in keys if key in document}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 8])
+def test_scanner_chunk_boundaries_in_escapes(chunk_size):
+    text = r'{"a\"b": "x\\", "skip": ["\\\"]", {"}": "\\"}], "turns": 12, "currentPlayer": "Ro\"me\\"}'
+    chunks = [text[start:start + chunk_size] for start in range(0, len(text), chunk_size)]
+
+    found = _TopLevelScanner(iter(chunks)).scan({"a\"b", "turns", "currentPlayer"})
+
+    assert found == {"a\"b": "x\\", "turns": 12, "currentPlayer": "Ro\"me\\"}
+
+
+def test_scanner_missing_keys():
+    assert _TopLevelScanner(iter(["{}"])).scan({"turns"}) == dict()
+    assert _TopLevelScanner(iter(['{"a": 1}'])).scan({"turns"}) == dict()
+    assert _TopLevelScanner(iter(['{"a": 1}'])).scan(set()) == dict()
+
+
+def test_scanner_truncated_file():
+    with pytest.raises(ValueError):
+        _TopLevelScanner(iter(['{"a": [1, 2', ", 3"])).scan({"turns"})
+
+
+@pytest.mark.parametrize("backend", available_json_backends())
+@pytest.mark.parametrize("streaming", [False, True])
+@pytest.mark.parametrize("encoding", ["plain", "gzip", "base64-gzip"])
+def test_decode_keys(backend, streaming, encoding):
+    document = {"civilizations": [{"civName": "Rome"}], "currentPlayer": "Rome", "turns": 7, "text": "Zürich"}
+    payload = json.dumps(document, ensure_ascii=False).encode("utf8")
+    if encoding != "plain":
+        payload = gzip.compress(payload)
+    if encoding == "base64-gzip":
+        payload = base64.b64encode(payload)
+
+    assert _decode(payload, backend=backend, streaming=streaming) == document
+    assert _decode(payload, frozenset({"currentPlayer", "turns", "missing"}), backend, streaming) == {
+        "currentPlayer": "Rome", "turns": 7
+    }
+
+
+@pytest.mark.parametrize("encoding", ["plain", "gzip", "base64-gzip"])
+def test_iter_text_splits_multibyte_characters(encoding):
+    text = json.dumps({"text": "東京" * 50_000}, ensure_ascii=False)
+    payload = text.encode("utf8")
+    if encoding != "plain":
+        payload = gzip.compress(payload)
+    if encoding == "base64-gzip":
+        payload = base64.b64encode(payload)
+
+    assert "".join(_iter_text(payload)) == text
+
+
+@pytest.mark.skipif("msgspec" not in available_json_backends(), reason="msgspec is not installed")
+def test_auto_backend_decodes_keys_with_msgspec(monkeypatch):
+    used = list()
+    get_json_backend = reader._get_json_backend
+    monkeypatch.setattr(reader, "_get_json_backend", lambda name: used.append(name) or get_json_backend(name))
+    payload = json.dumps({"currentPlayer": "Rome", "turns": 7}).encode("utf8")
+
+    _decode(payload, backend="auto")
+    _decode(payload, frozenset({"turns"}), backend="auto")
+
+    assert used == ["auto", "msgspec"]
+
+
+class _FakeResponse:
+    def __init__(self, status: int, headers: dict | None = None, body: bytes = b""):
+        self.status = status
+        self.headers = headers or dict()
+        self.content_length = None
+        self._body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def read(self) -> bytes:
+        return self._body
+
+
+class _FakeSession:
+    def __init__(self, head: _FakeResponse, get: _FakeResponse):
+        self._head = head
+        self._get = get
+        self.requests = list()
+
+    def head(self, url):
+        self.requests.append("HEAD")
+        return self._head
+
+    def get(self, url, headers=None):
+        self.requests.append("GET")
+        return self._get
+
+
+@pytest.mark.parametrize(("head", "get", "mode"), [
+    (503, 503, None),
+    (500, 200, None),
+    (405, 503, None),
+    (405, 200, reader._PROBE_NONE),
+    (501, 405, reader._PROBE_NONE),
+    (200, 206, reader._PROBE_RANGE),
+])
+def test_probe_mode_is_only_recorded_on_definitive_answers(monkeypatch, head, get, mode):
+    monkeypatch.setattr(reader, "_probe_modes", dict())
+    payload = gzip.compress(b'{"turns": 1}')
+    cached = reader._CachedGamefile(payload, b"", None, None)
+    tail = payload[-reader._PROBE_TAIL:]
+    session = _FakeSession(
+        _FakeResponse(head),
+        _FakeResponse(get, {"Content-Range": f"bytes 0-31/{len(payload)}"}, tail if get == 206 else payload)
+    )
+
+    unchanged = asyncio.run(reader._probe_unchanged(session, "https://uncivserver.xyz", "game", cached))
+
+    assert unchanged == (mode == reader._PROBE_RANGE)
+    assert reader._probe_modes.get("uncivserver.xyz", None) == mode
+
+
+def test_transient_members_expire(monkeypatch):
+    key = ("https://uncivserver.xyz", "game")
+    cached = reader._CachedGamefile(b'{"currentPlayer": "Rome", "turns": 7, "civilizations": []}', b"", None, None)
+    monkeypatch.setattr(reader, "_cache", reader.OrderedDict({key: cached}))
+    monkeypatch.setattr(reader, "_transient_expiry", reader.OrderedDict())
+
+    async def read(keys, max_age=None):
+        async with reader.gamefile(*key, keys=keys, max_age=max_age) as f:
+            return f
+
+    async def run():
+        polled = await read(("currentPlayer", "turns"), max_age=float("inf"))
+        registered = await read(("civilizations",))
+        assert await read(("civilizations",)) is registered
+
+        reader._transient_expiry[key] = 0
+        assert await read(("currentPlayer", "turns"), max_age=float("inf")) is polled
+        assert await read(("civilizations",)) is not registered
+        reader.shutdown_decoder()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(("head", "get", "exists", "requests"), [
+    (200, 200, True, ["HEAD", "HEAD"]),
+    (404, 200, True, ["HEAD", "GET", "HEAD", "GET"]),
+    (404, 404, False, ["HEAD", "GET", "HEAD", "GET"]),
+    (405, 200, True, ["HEAD", "GET", "GET"]),
+    (501, 404, False, ["HEAD", "GET", "GET"]),
+])
+def test_game_exists_falls_back_to_get(monkeypatch, head, get, exists, requests):
+    session = _FakeSession(_FakeResponse(head), _FakeResponse(get))
+    monkeypatch.setattr(reader, "_head_unsupported", set())
+    monkeypatch.setattr(reader, "_server_health", dict())
+    monkeypatch.setattr(reader, "_host_limiters", dict())
+
+    async def open_session():
+        return session
+
+    monkeypatch.setattr(reader, "open_session", open_session)
+
+    async def run():
+        return [await reader.game_exists("https://uncivserver.xyz", "game") for _ in range(2)]
+
+    assert asyncio.run(run()) == [exists, exists]
+    assert session.requests == requests
+
+
+def test_game_exists_raises_on_server_errors(monkeypatch):
+    session = _FakeSession(_FakeResponse(503), _FakeResponse(200))
+    monkeypatch.setattr(reader, "_head_unsupported", set())
+    monkeypatch.setattr(reader, "_server_health", dict())
+    monkeypatch.setattr(reader, "_host_limiters", dict())
+
+    async def open_session():
+        return session
+
+    monkeypatch.setattr(reader, "open_session", open_session)
+
+    with pytest.raises(reader.ServerUnavailableError):
+        asyncio.run(reader.game_exists("https://uncivserver.xyz", "game"))
+    assert session.requests == ["HEAD"]
+
+
+@pytest.fixture
+def isolated_reader(monkeypatch):
+    """ Fresh cache and per-host state of the reader, with the configuration returned by the fixture """
+
+    config = Config()
+    monkeypatch.setattr(reader, "get_config", lambda: config)
+    monkeypatch.setattr(reader, "_session", None)
+    monkeypatch.setattr(reader, "_cache", OrderedDict())
+    monkeypatch.setattr(reader, "_cache_size", 0)
+    monkeypatch.setattr(reader, "_fetches", dict())
+    monkeypatch.setattr(reader, "_probe_modes", dict())
+    monkeypatch.setattr(reader, "_head_unsupported", set())
+    monkeypatch.setattr(reader, "_server_health", dict())
+    monkeypatch.setattr(reader, "_host_limiters", dict())
+    return config
+
+
+async def _serve(handler) -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    app.router.add_route("*", "/files/{game_id}", handler)
+    runner = web.AppRunner(app, shutdown_timeout=0.1)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    return runner, f"http://127.0.0.1:{runner.addresses[0][1]}"
+
+
+def test_download_keeps_the_session_read_timeout(isolated_reader):
+    isolated_reader.HTTP_READ_TIMEOUT = 0.2
+
+    async def stall(request):
+        await asyncio.sleep(5)
+        return web.Response(body=b"{}")
+
+    async def run():
+        runner, server = await _serve(stall)
+        started = time.monotonic()
+        try:
+            with pytest.raises(reader.ServerUnavailableError):
+                await reader._download(server, "game")
+            return time.monotonic() - started
+        finally:
+            await reader.close_session()
+            await runner.cleanup()
+
+    assert asyncio.run(run()) < 2
+
+
+def _fail(health: reader._ServerHealth) -> None:
+    with pytest.raises(reader.ServerUnavailableError):
+        with health.request():
+            raise asyncio.TimeoutError()
+
+
+def _is_admitted(health: reader._ServerHealth) -> bool:
+    try:
+        with health.request():
+            return True
+    except reader.ServerUnavailableError:
+        return False
+
+
+def test_circuit_opens_after_threshold():
+    health = reader._ServerHealth("uncivserver.xyz", 3, 30, 900)
+
+    for _ in range(2):
+        _fail(health)
+    assert not health.unavailable
+
+    _fail(health)
+    assert health.unavailable
+    assert not _is_admitted(health)
+
+
+def test_circuit_lets_a_single_probe_through():
+    health = reader._ServerHealth("uncivserver.xyz", 1, 0.05, 900)
+    _fail(health)
+    time.sleep(0.06)
+
+    with health.request():
+        assert not _is_admitted(health)
+
+    assert not health.unavailable
+    assert _is_admitted(health)
+
+
+def test_circuit_backoff_doubles_up_to_the_maximum():
+    health = reader._ServerHealth("uncivserver.xyz", 1, 0.02, 0.05)
+    _fail(health)
+
+    delays = list()
+    for _ in range(3):
+        time.sleep(health._delay + 0.01)
+        _fail(health)
+        delays.append(health._delay)
+        assert not _is_admitted(health)
+
+    assert delays == [0.04, 0.05, 0.05]
+
+
+def test_queued_requests_are_rejected_once_the_circuit_opens(monkeypatch, isolated_reader):
+    isolated_reader.CIRCUIT_FAILURE_THRESHOLD = 3
+    isolated_reader.FETCH_CONCURRENCY_PER_HOST = 2
+    requests = list()
+
+    class TimingOut:
+        async def __aenter__(self):
+            requests.append(None)
+            await asyncio.sleep(0.01)
+            raise asyncio.TimeoutError()
+
+        async def __aexit__(self, *exc_info):
+            return False
+
+    class Session:
+        def get(self, url, headers=None):
+            return TimingOut()
+
+    async def open_session():
+        return Session()
+
+    monkeypatch.setattr(reader, "open_session", open_session)
+
+    async def run():
+        downloads = [reader._download("https://uncivserver.xyz", str(i)) for i in range(20)]
+        return await asyncio.gather(*downloads, return_exceptions=True)
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(result, reader.ServerUnavailableError) for result in results)
+    assert len(requests) == 3
+
+
+@pytest.mark.parametrize("status", [403, 404, 429])
+def test_error_responses_are_not_cached(isolated_reader, status):
+    isolated_reader.PROBE_BEFORE_DOWNLOAD = False
+    statuses = [200, status]
+
+    async def answer(request):
+        answered = statuses.pop(0)
+        return web.Response(status=answered, body=b'{"turns": 1}' if answered == 200 else b"Not found")
+
+    async def run():
+        runner, server = await _serve(answer)
+        try:
+            cached = await reader._download(server, "game")
+            with pytest.raises(reader.GamefileError) as err:
+                await reader._download(server, "game")
+            assert err.value.status == status
+            assert reader._cache[(server, "game")] is cached
+            assert cached.payload == b'{"turns": 1}'
+
+            reader.forget(server, "game")
+            statuses.append(status)
+            with pytest.raises(reader.GamefileError):
+                await reader._download(server, "game")
+            assert (server, "game") not in reader._cache
+        finally:
+            await reader.close_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+
+@pytest.mark.parametrize(("honours_conditions", "requests"), [
+    (True, ["GET", "GET", "GET"]),
+    (False, ["GET", "GET", "HEAD"]),
+])
+def test_probe_only_without_conditional_requests(isolated_reader, honours_conditions, requests):
+    received = list()
+
+    async def answer(request):
+        received.append(request.method)
+        if honours_conditions and request.headers.get("If-None-Match", None) == '"1"':
+            return web.Response(status=304, headers={"ETag": '"1"'})
+        return web.Response(body=b'{"turns": 1}', headers={"ETag": '"1"'})
+
+    async def run():
+        runner, server = await _serve(answer)
+        try:
+            cached = await reader._download(server, "game")
+            for _ in range(2):
+                assert await reader._download(server, "game") is cached
+        finally:
+            await reader.close_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    assert received == requests
+
+
+def test_head_probe_detects_a_changed_size(isolated_reader):
+    sizes = [b'{"turns": 1}', b'{"turns": 10}']
+    received = list()
+
+    # The file changes after the second download, keeping its weak validator
+    async def answer(request):
+        body = sizes[0] if len(received) < 2 else sizes[1]
+        received.append(request.method)
+        return web.Response(body=b"" if request.method == "HEAD" else body, headers={
+            "ETag": 'W/"weak"', "Content-Length": str(len(body))
+        })
+
+    async def run():
+        runner, server = await _serve(answer)
+        try:
+            await reader._download(server, "game")
+            await reader._download(server, "game")
+            assert (await reader._download(server, "game")).payload == sizes[1]
+        finally:
+            await reader.close_session()
+            await runner.cleanup()
+
+    asyncio.run(run())
+
+    assert received == ["GET", "GET", "HEAD", "GET"]
@@ -0,0 +1,100 @@
+import asyncio
+
+from telegram.ext import ExtBot, PicklePersistence
+
+from datatypes import Registration
+from storage import SqlitePersistence
+
+
+def _registration(chatid: int, name: str = "game", **kwargs) -> Registration:
+    return Registration(
+        name=name,
+        server="https://uncivserver.xyz",
+        gameid="00000000-0000-0000-0000-000000000001",
+        nation="Rome",
+        chatid=chatid,
+        period=60,
+        **kwargs
+    )
+
+
+def _reload(path) -> dict:
+    async def load():
+        persistence = SqlitePersistence(path)
+        try:
+            return await persistence.get_user_data()
+        finally:
+            await persistence.flush()
+
+    return asyncio.run(load())
+
+
+def test_same_name_in_two_chats_round_trip(tmp_path):
+    path = tmp_path / "storage.sqlite3"
+
+    async def store():
+        persistence = SqlitePersistence(path)
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {"games": [_registration(1), _registration(-100)]})
+        await persistence.flush()
+
+    asyncio.run(store())
+
+    games = _reload(path)[1]["games"]
+    assert [(game.chatid, game.name) for game in games] == [(1, "game"), (-100, "game")]
+
+
+def test_changes_and_removals_are_written(tmp_path):
+    path = tmp_path / "storage.sqlite3"
+    private, group = _registration(1), _registration(-100)
+
+    async def store():
+        persistence = SqlitePersistence(path)
+        await persistence.get_user_data()
+        await persistence.update_user_data(1, {"games": [private, group]})
+        group.last_notification_turn = 7
+        await persistence.update_user_data(1, {"games": [group]})
+        await persistence.flush()
+
+    asyncio.run(store())
+
+    games = _reload(path)[1]["games"]
+    assert [(game.chatid, game.last_notification_turn) for game in games] == [(-100, 7)]
+
+
+def test_pickle_migration(tmp_path):
+    legacy_path = tmp_path / "storage.pickle"
+    path = tmp_path / "storage.sqlite3"
+    legacy_game = dict(
+        _registration(1).as_dict(),
+        last_notification_turn=3,
+        next_notification_time="2026-01-01T00:00:00"
+    )
+    del legacy_game["next_notification_at"]
+
+    async def write_legacy():
+        legacy = PicklePersistence(legacy_path)
+        legacy.set_bot(ExtBot("123456:test"))
+        await legacy.update_user_data(1, {"games": [legacy_game]})
+        await legacy.update_conversation("register", (1, 1), 2)
+        await legacy.flush()
+
+    async def migrate():
+        persistence = SqlitePersistence(path, legacy_filepath=legacy_path)
+        persistence.set_bot(ExtBot("123456:test"))
+        try:
+            return await persistence.get_user_data(), await persistence.get_conversations("register")
+        finally:
+            await persistence.flush()
+
+    asyncio.run(write_legacy())
+    user_data, conversations = asyncio.run(migrate())
+
+    game = user_data[1]["games"][0]
+    assert isinstance(game, Registration)
+    assert (game.chatid, game.name, game.last_notification_turn) == (1, "game", 3)
+    assert game.next_notification_at > 0
+    assert conversations == {(1, 1): 2}
+
+    # The pickle file is only imported once
+    assert len(_reload(path)[1]["games"]) == 1
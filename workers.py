@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import random
+from logging import getLogger
+from multiprocessing.connection import Connection
+from typing import Any, Awaitable, Callable
+
+from datatypes import get_config
+from metrics import Gauge
+from reader import gamefile, forget, open_session, close_session, shutdown_decoder, ServerUnavailableError
+
+_logger = getLogger(__name__)
+
+_pool: _WorkerPool | None = None
+
+Gauge("unciv_poll_workers", "Running poll worker processes", lambda: _pool.running if _pool else 0)
+Gauge("unciv_worker_games", "Games polled by worker processes", lambda: _pool.assigned if _pool else 0)
+
+StateCallback = Callable[[str, str, str, int], Awaitable[None]]
+
+
+def start_workers(count: int, callback: StateCallback) -> None:
+    """
+    Poll the games in `count` worker processes instead of the job queue. The state of every polled game is passed to
+    `callback(server, gameid, nation, turn)` in this process.
+    """
+
+    global _pool
+
+    if _pool is None:
+        _pool = _WorkerPool(callback)
+        for slot in range(count):
+            _pool.add_worker(slot)
+
+
+async def stop_workers() -> None:
+    global _pool
+
+    if _pool is not None:
+        await _pool.stop(get_config().WORKER_SHUTDOWN_TIMEOUT)
+        _pool = None
+
+
+def workers_running() -> bool:
+    return _pool is not None
+
+
+def assign_game(server: str, gameid: str, period: float) -> None:
+    """ Poll the game every `period` seconds in the worker owning it """
+
+    _pool.assign(server, gameid, period)
+
+
+def release_game(server: str, gameid: str) -> None:
+    if _pool is not None:
+        _pool.release(server, gameid)
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode("utf8"), digest_size=8).digest(), "big")
+
+
+class _HashRing:
+    """
+    Consistent hashing of games to worker slots. Every slot owns many points of the ring, so adding or removing a slot
+    only moves the games of the points next to its own, spread evenly over the other slots.
+    """
+
+    _POINTS_PER_SLOT = 64
+
+    _points: list[int]
+    _slots: dict[int, int]
+
+    def __init__(self):
+        self._points = list()
+        self._slots = dict()
+
+    def add(self, slot: int) -> None:
+        for i in range(self._POINTS_PER_SLOT):
+            point = _hash(f"worker-{slot}-{i}")
+            if point not in self._slots:
+                bisect.insort(self._points, point)
+            self._slots[point] = slot
+
+    def remove(self, slot: int) -> None:
+        self._points = [point for point in self._points if self._slots[point] != slot]
+        self._slots = {point: self._slots[point] for point in self._points}
+
+    def get(self, server: str, gameid: str) -> int | None:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(f"{server} {gameid}")) % len(self._points)
+        return self._slots[self._points[index]]
+
+
+class _WorkerHandle:
+    slot: int
+    process: multiprocessing.Process
+    connection: Connection
+
+    def __init__(self, slot: int, process: multiprocessing.Process, connection: Connection):
+        self.slot = slot
+        self.process = process
+        self.connection = connection
+
+
+class _WorkerPool:
+    """
+    Front side of the worker processes. Owns the assignment of games to workers and passes the reported states on.
+
+    Notification state stays in the front process, so a game moving between workers cannot notify twice: reports of a
+    worker no longer owning the game are dropped, and the states reported by the new owner are deduplicated by the
+    turn notification state of the registrations like any other poll.
+    """
+
+    _RESTART_DELAY = 5
+
+    _callback: StateCallback
+    _context: Any
+    _ring: _HashRing
+    _workers: dict[int, _WorkerHandle]
+    _games: dict[tuple[str, str], float]
+    _owners: dict[tuple[str, str], int]
+    _reporting: set[asyncio.Task]
+    _stopping: bool
+
+    def __init__(self, callback: StateCallback):
+        self._callback = callback
+        # Spawn instead of fork, a forked child would inherit the running event loop and the Telegram connections
+        self._context = multiprocessing.get_context("spawn")
+        self._ring = _HashRing()
+        self._workers = dict()
+        self._games = dict()
+        self._owners = dict()
+        self._reporting = set()
+        self._stopping = False
+
+    @property
+    def running(self) -> int:
+        return len(self._workers)
+
+    @property
+    def assigned(self) -> int:
+        return len(self._owners)
+
+    def add_worker(self, slot: int) -> None:
+        connection, child_connection = self._context.Pipe()
+        process = self._context.Process(
+            target=_run_worker, args=(slot, child_connection), name=f"poll-worker-{slot}", daemon=True
+        )
+        process.start()
+        child_connection.close()
+
+        worker = _WorkerHandle(slot, process, connection)
+        self._workers[slot] = worker
+        asyncio.get_running_loop().add_reader(connection.fileno(), self._receive, worker)
+        self._ring.add(slot)
+        _logger.info("Started poll worker %s pid=%s", slot, process.pid)
+        self._rebalance()
+
+    def remove_worker(self, slot: int) -> None:
+        worker = self._workers.pop(slot, None)
+        if worker is None:
+            return
+
+        asyncio.get_running_loop().remove_reader(worker.connection.fileno())
+        self._ring.remove(slot)
+        self._send(worker, ("stop",))
+        worker.connection.close()
+        for game_key in [game_key for game_key, owner in self._owners.items() if owner == slot]:
+            del self._owners[game_key]
+        self._rebalance()
+
+    def assign(self, server: str, gameid: str, period: float) -> None:
+        game_key = (server, gameid)
+        if self._games.get(game_key, None) == period:
+            return
+
+        self._games[game_key] = period
+        self._owners.pop(game_key, None)
+        self._place(game_key)
+
+    def release(self, server: str, gameid: str) -> None:
+        game_key = (server, gameid)
+        self._games.pop(game_key, None)
+        slot = self._owners.pop(game_key, None)
+        if slot is not None:
+            self._send(self._workers[slot], ("release", server, gameid))
+
+    async def stop(self, timeout: float) -> None:
+        self._stopping = True
+        loop = asyncio.get_running_loop()
+
+        for worker in list(self._workers.values()):
+            loop.remove_reader(worker.connection.fileno())
+            self._send(worker, ("stop",))
+
+        for worker in list(self._workers.values()):
+            await asyncio.to_thread(worker.process.join, timeout)
+            if worker.process.is_alive():
+                _logger.warning("Poll worker %s did not stop in time, terminating it", worker.slot)
+                worker.process.terminate()
+            worker.connection.close()
+
+        self._workers.clear()
+        self._owners.clear()
+        await asyncio.gather(*self._reporting, return_exceptions=True)
+
+    def _rebalance(self) -> None:
+        """ Move every game whose ring slot changed to its new owner """
+
+        moved = 0
+        for game_key in self._games:
+            if self._owners.get(game_key, None) != self._ring.get(*game_key):
+                moved += self._place(game_key)
+
+        if moved:
+            _logger.info("Moved %s games between %s poll workers", moved, len(self._workers))
+
+    def _place(self, game_key: tuple[str, str]) -> bool:
+        slot = self._ring.get(*game_key)
+        if slot is None:
+            return False
+
+        # Release before assigning, so there is at most a short overlap of two workers polling the game
+        previous = self._owners.get(game_key, None)
+        if previous is not None and previous in self._workers:
+            self._send(self._workers[previous], ("release", *game_key))
+
+        self._owners[game_key] = slot
+        self._send(self._workers[slot], ("assign", *game_key, self._games[game_key]))
+        return True
+
+    def _send(self, worker: _WorkerHandle, message: tuple) -> None:
+        try:
+            worker.connection.send(message)
+        except (OSError, ValueError):
+            _logger.debug("Poll worker %s is gone, dropping message %s", worker.slot, message[0])
+
+    def _receive(self, worker: _WorkerHandle) -> None:
+        try:
+            while worker.connection.poll():
+                message = worker.connection.recv()
+                if message[0] == "state":
+                    self._report(worker, *message[1:])
+        except (EOFError, OSError):
+            self._lost(worker)
+
+    def _report(self, worker: _WorkerHandle, server: str, gameid: str, nation: str, turn: int) -> None:
+        if self._owners.get((server, gameid), None) != worker.slot:
+            _logger.debug("Dropping state of a game moved away from worker %s gameid=%s", worker.slot, gameid)
+            return
+
+        task = asyncio.create_task(self._notify(server, gameid, nation, turn))
+        self._reporting.add(task)
+        task.add_done_callback(self._reporting.discard)
+
+    async def _notify(self, server: str, gameid: str, nation: str, turn: int) -> None:
+        try:
+            await self._callback(server, gameid, nation, turn)
+        except Exception:
+            _logger.exception("Handling game state failed server=%s, gameid=%s", server, gameid)
+
+    def _lost(self, worker: _WorkerHandle) -> None:
+        if self._stopping or self._workers.get(worker.slot, None) is not worker:
+            return
+
+        _logger.error("Poll worker %s exited, restarting it in %s seconds", worker.slot, self._RESTART_DELAY)
+        self.remove_worker(worker.slot)
+        asyncio.get_running_loop().call_later(self._RESTART_DELAY, self._restart, worker.slot)
+
+    def _restart(self, slot: int) -> None:
+        if not self._stopping and slot not in self._workers:
+            self.add_worker(slot)
+
+
+def _run_worker(slot: int, connection: Connection) -> None:
+    """ Entry point of a worker process """
+
+    try:
+        asyncio.run(_Worker(slot, connection).run())
+    except KeyboardInterrupt:
+        pass
+
+
+class _Worker:
+    """ Polls the games assigned by the front process and reports their state back """
+
+    _slot: int
+    _connection: Connection
+    _polls: dict[tuple[str, str], asyncio.Task]
+    _stopped: asyncio.Event
+
+    def __init__(self, slot: int, connection: Connection):
+        self._slot = slot
+        self._connection = connection
+        self._polls = dict()
+        self._stopped = asyncio.Event()
+
+    async def run(self) -> None:
+        await open_session()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self._connection.fileno(), self._receive)
+        try:
+            await self._stopped.wait()
+        finally:
+            loop.remove_reader(self._connection.fileno())
+            for task in self._polls.values():
+                task.cancel()
+            await asyncio.gather(*self._polls.values(), return_exceptions=True)
+            await close_session()
+            shutdown_decoder()
+
+    def _receive(self) -> None:
+        try:
+            while self._connection.poll():
+                self._handle(self._connection.recv())
+        except (EOFError, OSError):
+            # The front process is gone
+            self._stopped.set()
+
+    def _handle(self, message: tuple) -> None:
+        if message[0] == "assign":
+            _, server, gameid, period = message
+            self._cancel((server, gameid))
+            self._polls[(server, gameid)] = asyncio.create_task(
+                self._poll(server, gameid, period), name=f"poll-{server}-{gameid}"
+            )
+        elif message[0] == "release":
+            _, server, gameid = message
+            self._cancel((server, gameid))
+            forget(server, gameid)
+        elif message[0] == "stop":
+            self._stopped.set()
+
+    def _cancel(self, game_key: tuple[str, str]) -> None:
+        task = self._polls.pop(game_key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _poll(self, server: str, gameid: str, period: float) -> None:
+        jitter = period * get_config().POLL_JITTER
+
+        # Spread the first polls over the whole period like the poll jobs do
+        await asyncio.sleep(random.uniform(0, period))
+        while True:
+            try:
+                async with gamefile(server, gameid, keys=("currentPlayer", "turns"), max_age=0) as f:
+                    nation = f.get_value("currentPlayer")
+                    turn = f.get_value("turns", required=False) or 0
+            except ServerUnavailableError as err:
+                _logger.debug("Polling game failed server=%s, gameid=%s: %s", server, gameid, err)
+            except Exception:
+                _logger.warning("Polling game failed server=%s, gameid=%s", server, gameid, exc_info=True)
+            else:
+                try:
+                    self._connection.send(("state", server, gameid, nation, turn))
+                except OSError:
+                    self._stopped.set()
+                    return
+
+            await asyncio.sleep(period + random.uniform(0, jitter))